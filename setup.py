@@ -33,6 +33,8 @@ setup(
     [console_scripts]
     flask-ctl = presence_analyzer.script:run
     get_user_xml = presence_analyzer.script:get_user_xml
+    import_profile = presence_analyzer.script:import_profile
+    validate_data = presence_analyzer.script:validate_data
 
     [paste.app_factory]
     main = presence_analyzer.script:make_app
@@ -4,4 +4,3 @@ Presence analyzer web app.
 """
 from .main import app
 from . import views
-from flask import render_template
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Selection of datasets served by a single application.
+
+Datasets are configured in DATASETS setting, a dict mapping dataset name
+to settings overriding application ones, e.g.:
+
+    DATASETS = {
+        'krakow': {
+            'DATA_CSV': '.../krakow.csv',
+            'DATA_XML': '.../krakow.xml',
+        },
+    }
+
+A dataset is selected by URL prefix (/krakow/api/v1/users) or by
+X-Dataset header, requests without any use application settings.
+
+Avatars of datasets which do not set their own AVATAR_DIR are cached
+in a subdirectory of the application one named after the dataset.
+"""
+
+from flask import request, has_request_context
+from werkzeug.exceptions import NotFound
+
+from presence_analyzer.main import app
+
+ENVIRON_KEY = 'presence_analyzer.dataset'
+
+
+class DatasetMiddleware(object):
+    """
+    WSGI middleware selecting dataset of request.
+
+    URL prefix of a dataset is moved to SCRIPT_NAME, so views and url_for
+    work the same for every dataset.
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        datasets = app.config.get('DATASETS') or {}
+        name = environ.get('HTTP_X_DATASET') or None
+        parts = environ.get('PATH_INFO', '').split('/', 2)
+        if len(parts) > 1 and parts[1] in datasets:
+            name = parts[1]
+            environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + \
+                '/' + name
+            environ['PATH_INFO'] = '/' + (parts[2] if len(parts) > 2 else '')
+        if name is not None and name not in datasets:
+            return NotFound()(environ, start_response)
+        environ[ENVIRON_KEY] = name
+        return self.wsgi_app(environ, start_response)
+
+
+app.wsgi_app = DatasetMiddleware(app.wsgi_app)
+
+
+def current_dataset():
+    """
+    Returns name of dataset of current request, None for the default one.
+    """
+    if not has_request_context():
+        return None
+    return request.environ.get(ENVIRON_KEY)
+
+
+def settings(name):
+    """
+    Returns application settings overridden by settings of dataset.
+    """
+    result = dict(app.config)
+    if name is not None:
+        result.update(app.config['DATASETS'][name])
+    return result
+
+
+def setting(key, default=None):
+    """
+    Returns setting of dataset of current request.
+    """
+    name = current_dataset()
+    if name is not None:
+        overrides = app.config['DATASETS'][name]
+        if key in overrides:
+            return overrides[key]
+    return app.config.get(key, default)
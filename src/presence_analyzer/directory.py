@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""
+Synchronization of the user directory XML and avatars with the intranet.
+"""
+
+import os
+import re
+import json
+import hashlib
+import urllib2
+from multiprocessing.pool import ThreadPool
+
+import logging
+
+from presence_analyzer.main import app
+from presence_analyzer.utils import write_atomic, load_file
+
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+
+def content_hashes(tree):
+    """
+    Returns hashes of server block and of every user in document order.
+
+    Comparing these lists detects changed, reordered and duplicated users,
+    while ignoring formatting of the document.
+    """
+    from lxml import etree
+    elements = tree.findall('.//server') + tree.findall('.//user')
+    return [
+        hashlib.sha1(
+            etree.tostring(element, method='c14n', with_tail=False)
+        ).hexdigest()
+        for element in elements
+    ]
+
+
+def xml_parser():
+    """
+    Returns parser ignoring formatting whitespace of directory XML.
+    """
+    from lxml import etree
+    return etree.XMLParser(remove_blank_text=True)
+
+
+def load_json(path):
+    """
+    Loads JSON file.
+    """
+    with open(path) as json_file:
+        return json.load(json_file)
+
+
+def read_meta(path):
+    """
+    Returns sync metadata stored next to the directory file.
+    """
+    try:
+        with open(path + '.meta') as meta_file:
+            return json.load(meta_file)
+    except (IOError, ValueError):
+        return {}
+
+
+def sync_user_xml(url, path, timeout=30):
+    """
+    Downloads user directory from url into path if it changed.
+
+    Uses ETag and Last-Modified of previous download for a conditional
+    request and compares per-user content hashes with the local copy.
+    The file is replaced with write-then-rename, so readers never see
+    a partial file, and only when content actually changed, so cached
+    directory of a running server stays valid otherwise.
+    Returns True when the file was replaced.
+    """
+    from lxml import etree
+    meta = read_meta(path) if os.path.exists(path) else {}
+
+    request = urllib2.Request(url)
+    if meta.get('etag'):
+        request.add_header('If-None-Match', meta['etag'])
+    if meta.get('last_modified'):
+        request.add_header('If-Modified-Since', meta['last_modified'])
+    try:
+        response = urllib2.urlopen(request, timeout=timeout)
+    except urllib2.HTTPError as error:
+        if error.code == 304:
+            log.debug('xml not modified. skipping.')
+            return False
+        raise
+    content = response.read()
+    remote_hashes = content_hashes(etree.fromstring(content, xml_parser()))
+
+    local_hashes = meta.get('hashes')
+    if local_hashes is None and os.path.exists(path):
+        local_hashes = content_hashes(etree.parse(path, xml_parser()))
+    changed = remote_hashes != local_hashes
+    if changed:
+        write_atomic(path, content)
+        log.debug('xml overwritten')
+    else:
+        log.debug('xml files do not differ. skipping.')
+
+    write_atomic(path + '.meta', json.dumps({
+        'etag': response.info().getheader('ETag'),
+        'last_modified': response.info().getheader('Last-Modified'),
+        'hashes': remote_hashes,
+    }))
+    return changed
+
+
+DEFAULT_PORTS = {'http': '80', 'https': '443'}
+AVATAR_NAME = re.compile(r'^[0-9a-f]{40}$')
+
+
+def server_url(tree):
+    """
+    Returns base URL of the intranet described in directory server block.
+    """
+    protocol = tree.find('.//protocol').text
+    url = protocol + "://" + tree.find('.//host').text
+    port = tree.find('.//port')
+    if port is not None and port.text != DEFAULT_PORTS.get(protocol):
+        url += ':' + port.text
+    return url
+
+
+def avatar_urls(tree):
+    """
+    Returns remote avatar URLs of all users in directory by user_id.
+    """
+    url = server_url(tree)
+    return {
+        user.get('id'): url + user.find('.//avatar').text
+        for user in tree.findall('.//user')
+    }
+
+
+def avatar_dir(name):
+    """
+    Returns directory of cached avatars of given dataset, None if
+    avatars are not cached.
+
+    Datasets which do not set AVATAR_DIR use a subdirectory of the
+    application one named after the dataset, so their avatar indexes
+    never overwrite each other.
+    """
+    if name is not None:
+        overrides = app.config['DATASETS'][name]
+        if 'AVATAR_DIR' in overrides:
+            return overrides['AVATAR_DIR']
+        if app.config.get('AVATAR_DIR'):
+            return os.path.join(app.config['AVATAR_DIR'], name)
+    return app.config.get('AVATAR_DIR')
+
+
+def check_avatar_dirs():
+    """
+    Raises ValueError when two datasets share avatar directory.
+    """
+    used = {}
+    for name in [None] + sorted(app.config.get('DATASETS') or {}):
+        path = avatar_dir(name)
+        if path is None:
+            continue
+        path = os.path.realpath(path)
+        if path in used:
+            raise ValueError(
+                'Datasets {0} and {1} share avatar directory {2}'.format(
+                    used[path], name, path
+                )
+            )
+        used[path] = name
+
+
+def avatar_index_path(avatar_dir):
+    """
+    Returns path of avatar index, mapping user_id to cached avatar.
+    """
+    return os.path.join(avatar_dir, 'index.json')
+
+
+def read_avatar_index(avatar_dir):
+    """
+    Returns avatar index, empty when avatars were never prefetched.
+    """
+    try:
+        return load_file(avatar_index_path(avatar_dir), load_json)
+    except (OSError, IOError, ValueError):
+        return {}
+
+
+def avatar_path(avatar_dir, digest):
+    """
+    Returns path of cached avatar with given content hash or None.
+    """
+    if not AVATAR_NAME.match(digest):
+        return None
+    path = os.path.join(avatar_dir, digest)
+    return path if os.path.exists(path) else None
+
+
+def prefetch_avatars(tree, avatar_dir, workers=4, timeout=10):
+    """
+    Downloads avatars of all users in directory into avatar_dir.
+
+    Avatars are fetched by a pool of `workers` threads, with conditional
+    requests for avatars fetched before, and stored under their content
+    hash. Avatars no longer referenced are removed. Users whose avatar
+    cannot be fetched keep their previous one. Returns the new index.
+    """
+    if not os.path.isdir(avatar_dir):
+        os.makedirs(avatar_dir)
+    previous = read_avatar_index(avatar_dir)
+
+    def fetch(item):
+        """
+        Fetches avatar of single user, returns its index entry.
+        """
+        user_id, url = item
+        entry = previous.get(user_id)
+        if entry is not None and \
+                avatar_path(avatar_dir, entry['hash']) is None:
+            entry = None
+        request = urllib2.Request(url)
+        if entry is not None and entry['url'] == url and entry.get('etag'):
+            request.add_header('If-None-Match', entry['etag'])
+        try:
+            response = urllib2.urlopen(request, timeout=timeout)
+            content = response.read()
+        except urllib2.HTTPError as error:
+            if error.code != 304:
+                log.warning('Cannot fetch avatar of user %s: %s',
+                            user_id, error)
+            return user_id, entry
+        except (urllib2.URLError, IOError) as error:
+            log.warning('Cannot fetch avatar of user %s: %s', user_id, error)
+            return user_id, entry
+
+        digest = hashlib.sha1(content).hexdigest()
+        if avatar_path(avatar_dir, digest) is None:
+            write_atomic(os.path.join(avatar_dir, digest), content)
+        return user_id, {
+            'url': url,
+            'hash': digest,
+            'etag': response.info().getheader('ETag'),
+        }
+
+    pool = ThreadPool(workers)
+    try:
+        results = pool.map(fetch, sorted(avatar_urls(tree).items()))
+    finally:
+        pool.close()
+        pool.join()
+
+    index = {user_id: entry for user_id, entry in results if entry}
+    write_atomic(avatar_index_path(avatar_dir), json.dumps(index))
+
+    used = set(entry['hash'] for entry in index.values())
+    for name in os.listdir(avatar_dir):
+        if AVATAR_NAME.match(name) and name not in used:
+            os.unlink(os.path.join(avatar_dir, name))
+    return index
@@ -4,13 +4,9 @@
 
 import os
 import sys
+import subprocess
 from functools import partial
 
-import paste.script.command
-import werkzeug.script
-
-from lxml import etree
-
 import logging
 log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
 
@@ -80,11 +76,13 @@ def _serve(action, debug=False, dry_run=False):
         ]
     sys.argv = argv[:2] + [abspath(config)] + argv[3:]
     # Run the 'paster' command
+    import paste.script.command
     paste.script.command.run()
 
 
 # bin/flask-ctl ...
 def run():
+    import werkzeug.script
     action_shell = werkzeug.script.make_shell(make_shell, make_shell.__doc__)
 
     # bin/flask-ctl serve [fg|start|stop|restart|status]
@@ -115,27 +113,166 @@ def run():
         """Stop the application."""
         _serve('stop', dry_run=dry_run)
 
+    # bin/flask-ctl stress
+    def action_stress(url='/api/v1/users', processes=1, threads=8,
+                      calls=50, max_p99=0.0, min_throughput=0.0):
+        """Stress the application with concurrent requests.
+
+        Exits with status 1 when any request failed, 99th percentile
+        of latency exceeds max_p99 seconds or throughput is lower than
+        min_throughput requests per second (limits are off when 0).
+        """
+        from presence_analyzer import stress
+        make_app()
+        if processes > 1:
+            result = stress.hammer_processes(url, processes, threads, calls)
+        else:
+            result = stress.hammer_url(url, threads, calls)
+        print result.report()
+        if result.errors or \
+                max_p99 and result.percentile(0.99) > max_p99 or \
+                min_throughput and result.throughput < min_throughput:
+            sys.exit(1)
+
+    # bin/flask-ctl json_benchmark
+    def action_json_benchmark(number=1000):
+        """Compare speed of JSON serializers on sample responses."""
+        from presence_analyzer import serializers
+        make_app()
+        for name, timings in serializers.benchmark(number).items():
+            print name, ' '.join(
+                '{0}={1:.1f}us'.format(payload, timings[payload])
+                for payload in sorted(timings)
+            )
+
     werkzeug.script.run()
 
 
 def get_user_xml():
     """
-    Gets xml file with user data.
+    Gets xml files with user data of all datasets.
     """
+    from lxml import etree
     from presence_analyzer import app
+    from presence_analyzer.datasets import settings
+    from presence_analyzer.directory import (
+        sync_user_xml, prefetch_avatars, read_avatar_index, avatar_dir,
+        check_avatar_dirs
+    )
     app.config.from_pyfile(abspath(DEPLOY_CFG))
-
-    url = "http://bolt/~sargo/users.xml"
-
-    remote_xml = etree.parse(url)
-    local_xml = etree.parse(app.config['DATA_XML'])
-
-    if set(remote_xml.getroot().itertext()) \
-       != set(local_xml.getroot().itertext()):
-
-        f = open('runtime/data/users.xml', 'w')
-        f.write(etree.tostring(remote_xml))
-        f.close()
-        log.debug('xml overwritten')
-    else:
-        log.debug('xml files do not differ. skipping.')
+    check_avatar_dirs()
+
+    for name in [None] + sorted(app.config.get('DATASETS') or {}):
+        config = settings(name)
+        url = config.get('USERS_XML_URL', "http://bolt/~sargo/users.xml")
+        changed = sync_user_xml(url, config['DATA_XML'])
+
+        directory = avatar_dir(name)
+        if directory and (changed or not read_avatar_index(directory)):
+            prefetch_avatars(etree.parse(config['DATA_XML']), directory,
+                             config.get('AVATAR_WORKERS', 4))
+
+
+# Runs in a fresh interpreter, prints "self cumulative depth name" lines
+# for every module imported for the first time.
+_IMPORT_PROFILER = """
+import sys, time
+try:
+    import __builtin__ as builtins
+except ImportError:
+    import builtins
+_import = builtins.__import__
+_children = [0.0]
+_report = []
+
+def _timed_import(name, *args, **kwargs):
+    if not name or name in sys.modules:
+        return _import(name, *args, **kwargs)
+    depth = len(_children)
+    _children.append(0.0)
+    started = time.time()
+    try:
+        return _import(name, *args, **kwargs)
+    finally:
+        elapsed = time.time() - started
+        children = _children.pop()
+        _children[-1] += elapsed
+        _report.append((elapsed - children, elapsed, depth, name))
+
+builtins.__import__ = _timed_import
+__import__(sys.argv[1])
+builtins.__import__ = _import
+for line in _report:
+    sys.stdout.write('%f %f %d %s\\n' % line)
+"""
+
+
+def import_times(module='presence_analyzer'):
+    """Import module in a fresh interpreter, return its import times.
+
+    Returns list of (self, cumulative, depth, name) tuples in import
+    completion order, times in seconds, like `python -X importtime`.
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    output = subprocess.check_output(
+        [sys.executable, '-c', _IMPORT_PROFILER, module], env=env
+    )
+    result = []
+    for line in output.splitlines():
+        own, cumulative, depth, name = line.split(' ', 3)
+        result.append((float(own), float(cumulative), int(depth), name))
+    return result
+
+
+# bin/import_profile [module] [--budget SECONDS]
+def import_profile():
+    """Print import time report and check it against startup budget."""
+    import argparse
+    parser = argparse.ArgumentParser(description=import_profile.__doc__)
+    parser.add_argument('module', nargs='?', default='presence_analyzer')
+    parser.add_argument('--budget', type=float, default=0.5,
+                        help='maximum import time in seconds')
+    args = parser.parse_args()
+
+    times = import_times(args.module)
+    print 'import time: self [us] | cumulative | imported package'
+    for own, cumulative, depth, name in times:
+        print 'import time: {0:>9} | {1:>10} | {2}{3}'.format(
+            int(own * 1e6), int(cumulative * 1e6), '  ' * depth, name)
+    total = sum(cumulative for own, cumulative, depth, name in times
+                if depth == 1)
+    print '{0}: {1:.3f}s of {2:.3f}s budget'.format(
+        args.module, total, args.budget)
+    if total > args.budget:
+        sys.exit(1)
+
+
+# bin/validate_data data.csv [--output data.clean.bin] [--report ...]
+def validate_data():
+    """Validate presence data, write anomaly report and cleaned file."""
+    import argparse
+    from presence_analyzer.validate import validate, MAX_DURATION
+    parser = argparse.ArgumentParser(description=validate_data.__doc__)
+    parser.add_argument('input', help='presence CSV file')
+    parser.add_argument('--output', help='cleaned file, binary if it ends '
+                        'with .bin (default: INPUT.clean.bin)')
+    parser.add_argument('--report', help='anomaly report '
+                        '(default: INPUT.report.csv)')
+    parser.add_argument('--checkpoint', help='progress file '
+                        '(default: INPUT.checkpoint)')
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    parser.add_argument('--max-duration', type=int, default=MAX_DURATION,
+                        help='longest possible presence in seconds')
+    args = parser.parse_args()
+
+    base = os.path.splitext(args.input)[0]
+    counts = validate(
+        args.input,
+        args.output or base + '.clean.bin',
+        args.report or base + '.report.csv',
+        args.checkpoint or base + '.checkpoint',
+        args.chunk_size,
+        args.max_duration,
+    )
+    for name in sorted(counts):
+        print '{0}: {1}'.format(name, counts[name])
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+JSON serializers of API responses.
+
+The fastest installed encoder is used unless JSON_SERIALIZER setting
+names one of BACKENDS. Encoders which do not reproduce floats exactly,
+like older ujson releases, are skipped.
+"""
+
+import json
+import timeit
+import calendar
+from itertools import islice
+from collections import OrderedDict
+
+from presence_analyzer.datasets import setting
+
+# floats which lose digits when encoded with limited precision
+FLOAT_SAMPLES = (1 / 7.0, 2 ** 0.5, 0.1, 1e22, 5e-324, 1.7976931348623157e308)
+
+
+def check_floats(name, encode):
+    """
+    Raises ValueError when floats encoded by encode are not decoded back
+    to the same values.
+    """
+    for value in FLOAT_SAMPLES:
+        if json.loads(encode([value])) != [value]:
+            raise ValueError(
+                'JSON serializer {0} rounds floats'.format(name)
+            )
+
+
+def load_ujson():
+    """
+    Returns encoder of ujson package.
+
+    ujson 1.x encodes floats with 10 digits by default and ujson 2.x
+    does not accept precision at all, so its default is checked.
+    """
+    import ujson
+    check_floats('ujson', ujson.dumps)
+    return ujson.dumps, ujson.dumps
+
+
+def load_simplejson():
+    """
+    Returns encoder of simplejson package.
+    """
+    import simplejson
+    encoder = simplejson.JSONEncoder(separators=(',', ':'))
+    return encoder.encode, encoder.encode
+
+
+def load_json():
+    """
+    Returns encoders of standard library json module.
+
+    Tables of rows never reference themselves, so they are encoded
+    without checking for circular references.
+    """
+    encoder = json.JSONEncoder(separators=(',', ':'))
+    table_encoder = json.JSONEncoder(
+        separators=(',', ':'), check_circular=False
+    )
+    return encoder.encode, table_encoder.encode
+
+
+# name: loader returning (encode, encode_table), fastest first, loaders
+# raise ImportError or ValueError when the backend can not be used
+BACKENDS = OrderedDict([
+    ('ujson', load_ujson),
+    ('simplejson', load_simplejson),
+    ('json', load_json),
+])
+
+
+class Serializer(object):
+    """
+    JSON serializer with a fast path for tables of rows.
+
+    Tables are lists of lists or tuples, like [['Mon', 0], ['Tue', 30047]]
+    returned by most views.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.encode, self.encode_table = BACKENDS[name]()
+
+    def dumps(self, obj):
+        """
+        Returns JSON representation of obj.
+        """
+        if is_table(obj):
+            return self.encode_table(obj)
+        return self.encode(obj)
+
+    def iterdumps(self, items, batch=1000):
+        """
+        Yields JSON representation of list of items in parts.
+
+        At most `batch` items are held in memory at once, so large
+        responses may be streamed while their items are produced.
+        """
+        items = iter(items)
+        separator = '['
+        while True:
+            chunk = list(islice(items, batch))
+            if not chunk:
+                break
+            yield separator + self.dumps(chunk)[1:-1]
+            separator = ','
+        yield '[]' if separator == '[' else ']'
+
+
+def is_table(obj):
+    """
+    Tells if obj looks like a list of rows.
+    """
+    return isinstance(obj, list) and bool(obj) and \
+        isinstance(obj[0], (list, tuple))
+
+
+_serializers = {}  # pylint: disable-msg=C0103
+
+
+def get_serializer(name=None):
+    """
+    Returns serializer of given backend, by default of the one named
+    in JSON_SERIALIZER setting or the fastest usable one.
+    """
+    name = name or setting('JSON_SERIALIZER')
+    try:
+        return _serializers[name]
+    except KeyError:
+        pass
+    if name is None:
+        candidates = list(BACKENDS)
+    elif name in BACKENDS:
+        candidates = [name]
+    else:
+        raise ValueError('Unknown JSON serializer: {0}'.format(name))
+    for candidate in candidates:
+        try:
+            serializer = Serializer(candidate)
+        except (ImportError, ValueError):
+            continue
+        _serializers[name] = serializer
+        return serializer
+    raise ValueError('JSON serializer not available: {0}'.format(name))
+
+
+def samples():
+    """
+    Returns payloads shaped like responses of API views, by name.
+    """
+    return {
+        'weekday': [['Weekday', 'Presence (s)']] + [
+            [day, 30047.0 + index * 1.5]
+            for index, day in enumerate(calendar.day_abbr)
+        ],
+        'occupancy': [['Time'] + list(calendar.day_abbr)] + [
+            ['{0:02d}:{1:02d}'.format(slot // 4, slot % 4 * 15)] +
+            [slot / 7.0] * 7
+            for slot in range(96)
+        ],
+        'users': [
+            {'user_id': user_id, 'name': 'User {0}'.format(user_id)}
+            for user_id in range(1000)
+        ],
+    }
+
+
+def benchmark(number=1000):
+    """
+    Measures encoding of sample payloads by json.dumps, used before
+    serializers were introduced, and by every installed serializer.
+
+    Returns {serializer name: {payload name: microseconds per call}}.
+    """
+    candidates = [('json.dumps', json.dumps)]
+    for name in BACKENDS:
+        try:
+            candidates.append((name, get_serializer(name).dumps))
+        except ValueError:
+            continue
+    results = OrderedDict()
+    for name, dumps in candidates:
+        results[name] = {
+            payload: min(timeit.repeat(
+                lambda: dumps(data), number=number, repeat=3
+            )) / number * 1e6
+            for payload, data in samples().items()
+        }
+    return results
@@ -0,0 +1,476 @@
+# -*- coding: utf-8 -*-
+"""
+Aggregates of presence data computed while data is loaded.
+"""
+
+import heapq
+import math
+from array import array
+from itertools import izip
+
+SLOT_SECONDS = 15 * 60
+SLOTS = 24 * 3600 // SLOT_SECONDS
+
+WORKING_WEEKDAYS = (0, 1, 2, 3, 4)
+NON_WORKING = 7
+
+
+def weekday(day):
+    """
+    Returns weekday (Monday is 0) of given date ordinal.
+    """
+    return (day + 6) % 7
+
+
+def slot_label(slot):
+    """
+    Returns HH:MM label of given slot start.
+    """
+    minutes = slot * SLOT_SECONDS // 60
+    return '{0:02d}:{1:02d}'.format(minutes // 60, minutes % 60)
+
+
+class Occupancy(object):
+    """
+    Typical day occupancy of 15 minute slots per weekday.
+
+    Every interval only marks its first and past-the-last slot in a
+    per-user difference array, prefix sums turn them into number of
+    presences in each slot once all rows are added.
+    """
+
+    def __init__(self):
+        self._diffs = {}
+        self._days = [set() for _ in range(7)]
+        self._users = {}
+        self._office = None
+
+    def add(self, user_id, day, start, end):
+        """
+        Adds single presence interval of user.
+        """
+        if end <= start:
+            return
+        try:
+            diff = self._diffs[user_id]
+        except KeyError:
+            diff = self._diffs[user_id] = array('i', [0] * 7 * (SLOTS + 1))
+        base = weekday(day) * (SLOTS + 1)
+        diff[base + start // SLOT_SECONDS] += 1
+        diff[base + (end - 1) // SLOT_SECONDS + 1] -= 1
+        self._days[weekday(day)].add(day)
+
+    def finish(self):
+        """
+        Turns difference arrays into slot counts.
+        """
+        office = array('i', [0] * 7 * SLOTS)
+        for user_id, diff in self._diffs.items():
+            counts = array('i', [0] * 7 * SLOTS)
+            for day in range(7):
+                present = 0
+                for slot in range(SLOTS):
+                    present += diff[day * (SLOTS + 1) + slot]
+                    counts[day * SLOTS + slot] = present
+                    office[day * SLOTS + slot] += present
+            self._users[user_id] = counts
+        self._office = office
+        self._diffs = {}
+
+    def typical_day(self, user_id=None):
+        """
+        Returns mean number of presences in every slot of every weekday.
+
+        Counts are divided by number of distinct dates of the weekday in
+        data, so the office-wide result is the mean headcount in a slot.
+        Without user_id returns the office-wide occupancy.
+        """
+        if user_id is None:
+            counts = self._office
+        else:
+            counts = self._users.get(user_id)
+        result = []
+        for day in range(7):
+            days = len(self._days[day])
+            if counts is None or not days:
+                result.append([0] * SLOTS)
+                continue
+            result.append([
+                float(counts[day * SLOTS + slot]) / days
+                for slot in range(SLOTS)
+            ])
+        return result
+
+
+class BucketSketch(object):
+    """
+    Mergeable quantile sketch based on fixed-width buckets.
+
+    Values are counted in buckets of `width` seconds, so memory is bounded
+    by number of buckets in a day and quantiles are exact up to half of
+    the bucket width.
+    """
+
+    def __init__(self, width=60):
+        self.width = width
+        self.count = 0
+        self._buckets = {}
+
+    def add(self, value):
+        """
+        Adds single value.
+        """
+        bucket = value // self.width
+        self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+        self.count += 1
+
+    def merge(self, other):
+        """
+        Adds all values of other sketch with the same bucket width.
+        """
+        if other.width != self.width:
+            raise ValueError('Cannot merge sketches of different widths')
+        for bucket, count in other._buckets.items():
+            self._buckets[bucket] = self._buckets.get(bucket, 0) + count
+        self.count += other.count
+
+    def quantile(self, fraction):
+        """
+        Returns nearest-rank quantile, e.g. 0.5 for median.
+
+        Result is the middle of the bucket holding the quantile, zero for
+        empty sketches.
+        """
+        if not self.count:
+            return 0
+        rank = max(int(math.ceil(fraction * self.count)), 1)
+        seen = 0
+        for bucket in sorted(self._buckets):
+            seen += self._buckets[bucket]
+            if seen >= rank:
+                break
+        return bucket * self.width + self.width // 2
+
+
+class Distributions(object):
+    """
+    Per-user, per-weekday sketches of presence time and arrival time.
+    """
+
+    def __init__(self, width=60):
+        self.width = width
+        self._sketches = {}
+
+    def add(self, user_id, day, start, end):
+        """
+        Adds single presence interval of user.
+        """
+        sketches = self._user_sketches(user_id)
+        sketches['presence'][weekday(day)].add(max(end - start, 0))
+        sketches['start'][weekday(day)].add(start)
+
+    def finish(self):
+        """
+        Sketches are complete as soon as rows are added.
+        """
+        pass
+
+    def merge(self, other):
+        """
+        Adds sketches of other distributions, e.g. of another data chunk.
+        """
+        for user_id, others in other._sketches.items():
+            for name, weekdays in others.items():
+                for day, sketch in enumerate(weekdays):
+                    self._user_sketches(user_id)[name][day].merge(sketch)
+
+    def _user_sketches(self, user_id):
+        """
+        Returns sketches of user, creating empty ones if needed.
+        """
+        try:
+            return self._sketches[user_id]
+        except KeyError:
+            sketches = self._sketches[user_id] = {
+                'presence': [BucketSketch(self.width) for _ in range(7)],
+                'start': [BucketSketch(self.width) for _ in range(7)],
+            }
+            return sketches
+
+    def quantiles(self, user_id, name, fractions):
+        """
+        Returns quantiles of metric ('presence' or 'start') of user
+        for every weekday.
+        """
+        sketches = self._sketches.get(user_id)
+        if sketches is None:
+            return [[0] * len(fractions) for _ in range(7)]
+        return [
+            [sketch.quantile(fraction) for fraction in fractions]
+            for sketch in sketches[name]
+        ]
+
+
+class WeekdayAggregates(object):
+    """
+    Mean presence time, arrival and leaving time of every user.
+
+    While loading only sums and counts are kept per user, finish() turns
+    them into dense users x 7 weekday matrices of means stored row-major
+    in arrays, plus means over all weekdays. Total presence time is kept
+    in a matrix of sums as well.
+    """
+
+    metrics = ('presence', 'start', 'end')
+
+    def __init__(self):
+        self._sums = {}
+        self.users = []
+        self.rows = {}
+        self.counts = array('i')
+        self.totals = array('l')
+        self.matrices = {}
+        self.overall = {}
+
+    def add(self, user_id, day, start, end):
+        """
+        Adds single presence interval of user.
+        """
+        try:
+            sums = self._sums[user_id]
+        except KeyError:
+            sums = self._sums[user_id] = [0] * 7 * 4
+        base = weekday(day) * 4
+        sums[base] += 1
+        sums[base + 1] += end - start
+        sums[base + 2] += start
+        sums[base + 3] += end
+
+    def finish(self):
+        """
+        Builds matrices of means out of collected sums.
+        """
+        self.users = sorted(self._sums)
+        self.rows = {user_id: row for row, user_id in enumerate(self.users)}
+        self.counts = array('i', [0] * len(self.users) * 7)
+        self.totals = array('l', [0] * len(self.users) * 7)
+        self.matrices = {
+            name: array('d', [0] * len(self.users) * 7)
+            for name in self.metrics
+        }
+        self.overall = {
+            name: array('d', [0] * len(self.users))
+            for name in self.metrics
+        }
+        for row, user_id in enumerate(self.users):
+            sums = self._sums[user_id]
+            count = sum(sums[day * 4] for day in range(7))
+            for day in range(7):
+                self.counts[row * 7 + day] = sums[day * 4]
+                self.totals[row * 7 + day] = sums[day * 4 + 1]
+            for offset, name in enumerate(self.metrics, 1):
+                total = sum(sums[day * 4 + offset] for day in range(7))
+                self.overall[name][row] = float(total) / count
+                for day in range(7):
+                    if sums[day * 4]:
+                        self.matrices[name][row * 7 + day] = \
+                            float(sums[day * 4 + offset]) / sums[day * 4]
+        self._sums = {}
+
+    def compare(self, user_ids):
+        """
+        Returns weekday rows of given users for every metric.
+
+        Rows are slices of the matrices, in order of user_ids, under
+        metric names plus 'days' with numbers of days present and
+        'total' with total presence time. Users without data get rows
+        of zeros.
+        """
+        zeros = [0] * 7
+        slices = [
+            slice(self.rows[user_id] * 7, self.rows[user_id] * 7 + 7)
+            if user_id in self.rows else None
+            for user_id in user_ids
+        ]
+        matrices = dict(self.matrices, days=self.counts, total=self.totals)
+        return {
+            name: [
+                matrix[part].tolist() if part is not None else zeros
+                for part in slices
+            ]
+            for name, matrix in matrices.items()
+        }
+
+    def top(self, name, number, day=None, smallest=False):
+        """
+        Returns `number` of (user_id, mean) pairs with highest means.
+
+        Means are taken over given weekday or over all weekdays, users
+        without presence on that weekday are skipped. With smallest set
+        lowest means are returned instead.
+        """
+        if day is None:
+            means = self.overall[name]
+            candidates = (
+                (means[row], user_id)
+                for row, user_id in enumerate(self.users)
+            )
+        else:
+            matrix = self.matrices[name]
+            candidates = (
+                (matrix[row * 7 + day], user_id)
+                for row, user_id in enumerate(self.users)
+                if self.counts[row * 7 + day]
+            )
+        select = heapq.nsmallest if smallest else heapq.nlargest
+        return [
+            (user_id, value)
+            for value, user_id in select(number, candidates)
+        ]
+
+
+class Calendar(object):
+    """
+    Working days of the period from `first` to `last` date ordinal.
+
+    `days` holds for every date of the period, at offset from `first`,
+    its weekday when it is a working day and NON_WORKING otherwise,
+    so telling working days apart takes a single lookup. Running counts
+    of working days by weekday let working_days_between count them
+    in any part of the period without scanning it.
+    """
+
+    def __init__(self, first, last, holidays=(),
+                 working_weekdays=WORKING_WEEKDAYS):
+        self.first = first
+        self.last = last
+        length = max(last - first + 1, 0)
+        week = bytearray(
+            day if day in working_weekdays else NON_WORKING
+            for day in range(7)
+        )
+        start = weekday(first)
+        week = week[start:] + week[:start]
+        self.days = (week * (length // 7 + 1))[:length]
+        for day in holidays:
+            if first <= day <= last:
+                self.days[day - first] = NON_WORKING
+        self.working_days = [self.days.count(chr(day)) for day in range(7)]
+
+        # counts of working days by weekday before every offset
+        counts = [0] * (NON_WORKING + 1)
+        self._prefix = array('i')
+        for key in self.days:
+            self._prefix.extend(counts[:7])
+            counts[key] += 1
+        self._prefix.extend(counts[:7])
+
+    def working_days_between(self, first, last):
+        """
+        Returns numbers of working days by weekday from `first` to `last`
+        date ordinal, both within the period.
+        """
+        low = (first - self.first) * 7
+        high = (last - self.first + 1) * 7
+        return [self._prefix[high + day] - self._prefix[low + day]
+                for day in range(7)]
+
+    def is_working(self, day):
+        """
+        Tells if given date ordinal within the period is a working day.
+        """
+        return self.days[day - self.first] != NON_WORKING
+
+
+class WorkingWeekdays(object):
+    """
+    Mean presence time of every user by weekday counting working days only.
+
+    Durations are collected per user while loading. finish() builds the
+    Calendar of the loaded period and sums them up by its precomputed
+    weekday of every date, so holidays and weekends land in a separate
+    NON_WORKING slot instead of being checked row by row. Working days
+    from first to last date of every user are kept for normalized means.
+    """
+
+    def __init__(self, holidays=(), working_weekdays=WORKING_WEEKDAYS):
+        self.holidays = holidays
+        self.working_weekdays = working_weekdays
+        self.calendar = None
+        self._columns = {}
+        self._sums = {}
+        self._counts = {}
+        self._working_days = {}
+
+    def add(self, user_id, day, start, end):
+        """
+        Adds single presence interval of user.
+        """
+        try:
+            days, durations = self._columns[user_id]
+        except KeyError:
+            days, durations = self._columns[user_id] = \
+                array('i'), array('i')
+        days.append(day)
+        durations.append(end - start)
+
+    def finish(self):
+        """
+        Builds calendar of loaded period and sums durations by weekday.
+        """
+        columns = self._columns.values()
+        if columns:
+            first = min(min(days) for days, _ in columns)
+            last = max(max(days) for days, _ in columns)
+        else:
+            first, last = 0, -1
+        self.calendar = Calendar(
+            first, last, self.holidays, self.working_weekdays
+        )
+        calendar_days = self.calendar.days
+        for user_id, (days, durations) in self._columns.items():
+            sums = [0] * (NON_WORKING + 1)
+            counts = [0] * (NON_WORKING + 1)
+            for day, duration in izip(days, durations):
+                key = calendar_days[day - first]
+                sums[key] += duration
+                counts[key] += 1
+            self._sums[user_id] = sums[:7]
+            self._counts[user_id] = counts[:7]
+            self._working_days[user_id] = self.calendar.working_days_between(
+                min(days), max(days)
+            )
+        self._columns = {}
+
+    def means(self, user_id, normalized=False):
+        """
+        Returns mean presence time of user on working days by weekday.
+
+        Means are taken over days the user was present, or with
+        normalized set over all working days from the first to the last
+        date of the user, absences counting as zero.
+        """
+        sums = self._sums.get(user_id, [0] * 7)
+        if normalized:
+            divisors = self._working_days.get(user_id, [0] * 7)
+        else:
+            divisors = self._counts.get(user_id, [0] * 7)
+        return [
+            float(total) / divisor if divisor else 0
+            for total, divisor in zip(sums, divisors)
+        ]
+
+
+def new_aggregates(holidays=(), working_weekdays=WORKING_WEEKDAYS):
+    """
+    Returns fresh aggregates filled by get_data, keyed by name.
+
+    Holidays are date ordinals, they and weekdays other than
+    working_weekdays are left out of working day aggregates.
+    """
+    return {
+        'occupancy': Occupancy(),
+        'distributions': Distributions(),
+        'weekdays': WeekdayAggregates(),
+        'working_days': WorkingWeekdays(holidays, working_weekdays),
+    }
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+Concurrency stress harness for the cache and data loading path.
+"""
+
+import math
+import time
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from functools import wraps
+
+from presence_analyzer.main import app
+from presence_analyzer import utils
+
+
+class StressResult(object):
+    """
+    Latencies and errors collected by a stress run.
+    """
+
+    def __init__(self, latencies, errors, elapsed):
+        self.latencies = sorted(latencies)
+        self.errors = errors
+        self.elapsed = elapsed
+
+    @property
+    def calls(self):
+        """
+        Number of completed calls.
+        """
+        return len(self.latencies)
+
+    @property
+    def throughput(self):
+        """
+        Completed calls per second.
+        """
+        return self.calls / self.elapsed if self.elapsed else 0.0
+
+    def percentile(self, fraction):
+        """
+        Returns latency at given fraction, e.g. 0.99 for p99.
+        """
+        return percentile(self.latencies, fraction)
+
+    def merge(self, other):
+        """
+        Returns result combining this and other run.
+        """
+        return StressResult(
+            self.latencies + other.latencies,
+            self.errors + other.errors,
+            max(self.elapsed, other.elapsed),
+        )
+
+    def report(self):
+        """
+        Returns one line summary of the run.
+        """
+        return (
+            '{0} calls, {1} errors, {2:.1f} calls/s, '
+            'p50 {3:.4f}s, p99 {4:.4f}s'.format(
+                self.calls, len(self.errors), self.throughput,
+                self.percentile(0.5), self.percentile(0.99),
+            )
+        )
+
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of sorted values. Returns zero for empty lists.
+    """
+    if not values:
+        return 0
+    rank = int(math.ceil(fraction * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+def hammer(func, threads=8, calls=50):
+    """
+    Calls func from many threads at once and collects latencies.
+
+    func gets no arguments, exceptions it raises are collected as errors.
+    """
+    latencies = []
+    errors = []
+    barrier = threading.Event()
+
+    def worker():
+        """
+        Single stress thread.
+        """
+        barrier.wait()
+        for _ in range(calls):
+            started = time.time()
+            try:
+                func()
+            except Exception as error:  # pylint: disable=W0703
+                errors.append(error)
+            else:
+                latencies.append(time.time() - started)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    started = time.time()
+    barrier.set()
+    for thread in workers:
+        thread.join()
+    return StressResult(latencies, errors, time.time() - started)
+
+
+def hammer_url(url, threads=8, calls=50):
+    """
+    Requests url through the test client from many threads at once.
+    """
+    def request():
+        """
+        Requests url and fails on unexpected status.
+        """
+        response = app.test_client().get(url)
+        if response.status_code != 200:
+            raise AssertionError(
+                '{0} returned {1}'.format(url, response.status_code)
+            )
+    return hammer(request, threads, calls)
+
+
+def _process_worker(args):
+    """
+    Runs hammer_url in a worker process, returns picklable results.
+    """
+    url, threads, calls = args
+    result = hammer_url(url, threads, calls)
+    return result.latencies, [repr(error) for error in result.errors], \
+        result.elapsed
+
+
+def hammer_processes(url, processes=2, threads=8, calls=50):
+    """
+    Requests url from many processes, each running many threads.
+
+    Every process has its own cache, so each of them loads data once.
+    """
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(
+            _process_worker, [(url, threads, calls)] * processes
+        )
+    finally:
+        pool.close()
+        pool.join()
+    merged = StressResult([], [], 0)
+    for latencies, errors, elapsed in results:
+        merged = merged.merge(StressResult(latencies, errors, elapsed))
+    return merged
+
+
+def counting_loader(loader, delay=0):
+    """
+    Wraps loader so it sleeps delay seconds and counts its calls.
+
+    Number of calls is available as `calls` attribute of the wrapper.
+    """
+    lock = threading.Lock()
+
+    @wraps(loader)
+    def wrapped():
+        """
+        Counts call and delays loader.
+        """
+        with lock:
+            wrapped.calls += 1
+        time.sleep(delay)
+        return loader()
+    wrapped.calls = 0
+    return wrapped
+
+
+@contextmanager
+def reloader(interval):
+    """
+    Clears the data cache every interval seconds while active.
+    """
+    stop = threading.Event()
+
+    def worker():
+        """
+        Reloading thread.
+        """
+        while not stop.wait(interval):
+            utils.mycache.clear()
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+@contextmanager
+def rewriter(path, versions, interval, in_place=False, pieces=4,
+             pause=0.005):
+    """
+    Keeps replacing path with subsequent versions while active.
+
+    By default files are replaced with write-then-rename, so a reader
+    which already opened the file keeps reading the version it started
+    with. With in_place set the file is truncated and rewritten in
+    `pieces` parts, `pause` seconds apart, so readers may see it
+    partially written or changing under them.
+    """
+    stop = threading.Event()
+
+    def write_in_place(content):
+        """
+        Rewrites file in parts.
+        """
+        size = len(content) // pieces + 1
+        with open(path, 'r+b') as target:
+            target.truncate(0)
+            for start in range(0, len(content), size):
+                target.write(content[start:start + size])
+                target.flush()
+                time.sleep(pause)
+
+    def worker():
+        """
+        Rewriting thread.
+        """
+        step = 0
+        while not stop.wait(interval):
+            step += 1
+            if in_place:
+                write_in_place(versions[step % len(versions)])
+            else:
+                utils.write_atomic(path, versions[step % len(versions)])
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
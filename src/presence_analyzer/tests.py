@@ -3,12 +3,21 @@
 Presence analyzer unit tests.
 """
 import os.path
+import csv
 import json
+import hashlib
 import datetime
 import unittest
 import time
+import shutil
+import tempfile
+import threading
+import BaseHTTPServer
 
-from presence_analyzer import main, utils
+from presence_analyzer import (
+    main, utils, stress, stats, script, directory, datasets, validate,
+    throttle, serializers
+)
 
 from lxml import etree
 
@@ -25,6 +34,71 @@ TEST_DATA_XSD = os.path.join(
 )
 
 
+USERS_XML = """<intranet>
+    <server>
+        <host>{host}</host>
+        <port>{port}</port>
+        <protocol>http</protocol>
+    </server>
+    <users>
+        <user id="141">
+            <avatar>/api/images/users/141</avatar>
+            <name>Adam Pie&#347;kiewicz</name>
+        </user>
+        <user id="176">
+            <avatar>/api/images/users/176</avatar>
+            <name>Adrian Kruszewski</name>
+        </user>
+    </users>
+</intranet>"""
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves contents registered in `files` of the stand-in server.
+    """
+
+    def do_GET(self):  # pylint: disable=C0103
+        """
+        Serves registered content, honours If-None-Match.
+        """
+        self.server.requests.append((self.path, dict(self.headers)))
+        if self.path not in self.server.files:
+            self.send_response(404)
+            self.end_headers()
+            return
+        content, etag = self.server.files[self.path]
+        if etag is not None and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        """
+        Keeps test output clean.
+        """
+        pass
+
+
+def start_stand_in(files):
+    """
+    Starts local HTTP server standing in for the intranet.
+    """
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.files = files
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
 # pylint: disable=E1103
 class PresenceAnalyzerViewsTestCase(unittest.TestCase):
     """
@@ -81,6 +155,40 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         self.assertListEqual(data[5], [u'Sat', 0])
         self.assertListEqual(data[6], [u'Sun', 0])
 
+    def test_mean_time_working_days(self):
+        """
+        Test mean presence time of working days of given user.
+        """
+        main.app.config['HOLIDAYS'] = ['2013-09-11']
+        utils.mycache.clear()
+        try:
+            resp = self.client.get('/api/v1/mean_time_weekday/10?days=working')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(json.loads(resp.data), [
+                [u'Mon', 0], [u'Tue', 30047.0], [u'Wed', 0],
+                [u'Thu', 23705.0], [u'Fri', 0], [u'Sat', 0], [u'Sun', 0],
+            ])
+            resp = self.client.get(
+                '/api/v1/mean_time_weekday/10?days=normalized'
+            )
+            self.assertEqual(json.loads(resp.data), [
+                [u'Mon', 0], [u'Tue', 30047.0], [u'Wed', 0],
+                [u'Thu', 23705.0], [u'Fri', 0], [u'Sat', 0], [u'Sun', 0],
+            ])
+            # absence on 2013-09-06 halves the mean of Friday
+            resp = self.client.get(
+                '/api/v1/mean_time_weekday/11?days=normalized'
+            )
+            self.assertListEqual(json.loads(resp.data)[4], [u'Fri', 3213.0])
+            resp = self.client.get('/api/v1/mean_time_weekday/10?days=all')
+            self.assertListEqual(json.loads(resp.data)[2],
+                                 [u'Wed', 24465.0])
+            resp = self.client.get('/api/v1/mean_time_weekday/10?days=x')
+            self.assertEqual(resp.status_code, 400)
+        finally:
+            main.app.config.pop('HOLIDAYS', None)
+            utils.mycache.clear()
+
     def test_presence_weekday_view(self):
         """
         Test total presence time of given user grouped by weekday.
@@ -99,6 +207,160 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         self.assertListEqual(data[6], [u'Sat', 0])
         self.assertListEqual(data[7], [u'Sun', 0])
 
+    def test_presence_quantiles_view(self):
+        """
+        Test median and p90 of presence time grouped by weekday.
+        """
+        resp = self.client.get('/api/v1/presence_quantiles/10')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 8)
+        self.assertListEqual(data[0], [u'Weekday', u'Median (s)', u'P90 (s)'])
+        self.assertListEqual(data[1], [u'Mon', 0, 0])
+        self.assertListEqual(data[2], [u'Tue', 30030, 30030])
+        self.assertListEqual(data[7], [u'Sun', 0, 0])
+
+    def test_start_quantiles_view(self):
+        """
+        Test median and p90 of arrival time grouped by weekday.
+        """
+        resp = self.client.get('/api/v1/start_quantiles/11')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 8)
+        self.assertListEqual(data[4], [u'Thu', 34110, 37110])
+
+        resp = self.client.get('/api/v1/start_quantiles/1234')
+        data = json.loads(resp.data)
+        self.assertListEqual(data[4], [u'Thu', 0, 0])
+
+    def test_top_view(self):
+        """
+        Test rankings of users.
+        """
+        resp = self.client.get('/api/v1/top/presence')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertListEqual(data, [
+            {u'user_id': 10, u'value': 26072.333333333332},
+            {u'user_id': 11, u'value': 19733.666666666668},
+        ])
+
+        resp = self.client.get('/api/v1/top/start?n=1&weekday=1')
+        data = json.loads(resp.data)
+        self.assertListEqual(data, [{u'user_id': 11, u'value': 33590.0}])
+
+        resp = self.client.get('/api/v1/top/start?weekday=1&order=desc')
+        data = json.loads(resp.data)
+        self.assertEqual([item['user_id'] for item in data], [10, 11])
+
+        resp = self.client.get('/api/v1/top/end?weekday=0')
+        data = json.loads(resp.data)
+        self.assertListEqual(data, [{u'user_id': 11, u'value': 57257.0}])
+
+        resp = self.client.get('/api/v1/top/lunch')
+        self.assertEqual(resp.status_code, 404)
+        resp = self.client.get('/api/v1/top/start?weekday=7')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_compare_view(self):
+        """
+        Test comparison of users by weekday.
+        """
+        resp = self.client.get('/api/v1/compare?users=10,12')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertItemsEqual(data, ['users', 'weekdays', 'presence',
+                                     'start', 'end', 'days', 'total'])
+        self.assertEqual(data['users'], [10, 12])
+        self.assertEqual(data['weekdays'][0], u'Mon')
+        self.assertEqual(data['presence'], [
+            [0, 30047.0, 24465.0, 23705.0, 0, 0, 0],
+            [0] * 7,
+        ])
+        self.assertEqual(data['days'], [[0, 1, 1, 1, 0, 0, 0], [0] * 7])
+        self.assertEqual(data['total'],
+                         [[0, 30047, 24465, 23705, 0, 0, 0], [0] * 7])
+        self.assertEqual(data['start'][0][1], 34745.0)
+
+        resp = self.client.get('/api/v1/compare?users=10,x')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get('/api/v1/compare')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get(
+            '/api/v1/compare?users=' + ','.join(['10'] * 101)
+        )
+        self.assertEqual(resp.status_code, 400)
+
+    def test_compare_view_duplicate_rows(self):
+        """
+        Test if comparison agrees with weekday views on duplicated rows.
+        """
+        tempdir = tempfile.mkdtemp()
+        data_csv = os.path.join(tempdir, 'data.csv')
+        with open(TEST_DATA_CSV) as source:
+            rows = source.read().rstrip('\n')
+        with open(data_csv, 'w') as csvfile:
+            csvfile.write(rows + '\n10,2013-09-10,09:00:00,10:00:00\n')
+        main.app.config.update({'DATA_CSV': data_csv})
+        utils.mycache.clear()
+        try:
+            data = json.loads(
+                self.client.get('/api/v1/compare?users=10,11').data
+            )
+            for row, user_id in enumerate([10, 11]):
+                presence = json.loads(self.client.get(
+                    '/api/v1/presence_weekday/{0}'.format(user_id)
+                ).data)
+                self.assertEqual(data['total'][row],
+                                 [total for _, total in presence[1:]])
+                means = json.loads(self.client.get(
+                    '/api/v1/mean_time_weekday/{0}'.format(user_id)
+                ).data)
+                self.assertEqual(data['presence'][row],
+                                 [value for _, value in means])
+            self.assertEqual(data['total'][0],
+                             [0, 3600, 24465, 23705, 0, 0, 0])
+            self.assertEqual(data['days'][0], [0, 1, 1, 1, 0, 0, 0])
+        finally:
+            main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+            utils.mycache.clear()
+            shutil.rmtree(tempdir)
+
+    def test_occupancy_view(self):
+        """
+        Test office-wide typical day occupancy.
+        """
+        resp = self.client.get('/api/v1/occupancy')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 97)
+        self.assertListEqual(data[0], [u'Time', u'Mon', u'Tue', u'Wed',
+                                       u'Thu', u'Fri', u'Sat', u'Sun'])
+        self.assertListEqual(data[38], [u'09:15', 1, 1, 2, 0.5, 0, 0, 0])
+        self.assertListEqual(data[39], [u'09:30', 1, 2, 2, 0.5, 0, 0, 0])
+        self.assertListEqual(data[57], [u'14:00', 1, 1, 2, 1.5, 1, 0, 0])
+
+    def test_user_occupancy_view(self):
+        """
+        Test typical day presence of given user.
+        """
+        resp = self.client.get('/api/v1/occupancy/10')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 97)
+        self.assertListEqual(data[38], [u'09:15', 0, 0, 1, 0, 0, 0, 0])
+        self.assertListEqual(data[39], [u'09:30', 0, 1, 1, 0, 0, 0, 0])
+
+        resp = self.client.get('/api/v1/occupancy/1234')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertListEqual(data[39], [u'09:30', 0, 0, 0, 0, 0, 0, 0])
+
     def test_presence_weekday_page(self):
         """
         Test presence by weekday page.
@@ -126,6 +388,43 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         self.assertIn('<li id="selected"><a href="mean_time_weekday.html">',
                       resp.data)
 
+    def test_page_bootstrap(self):
+        """
+        Test if pages embed user directory and chart data of selected user.
+        """
+        resp = self.client.get('/presence_weekday.html?user_id=10')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('"name": "Adam Pie\\u015bkiewicz", "user_id": "141"',
+                      resp.data)
+        self.assertIn('var stats = {"10": [["Weekday", "Presence (s)"], '
+                      '["Mon", 0], ["Tue", 30047]', resp.data)
+        self.assertIn('var selectedUser = "10";', resp.data)
+
+        resp = self.client.get('/mean_time_weekday.html')
+        self.assertIn('var stats = {};', resp.data)
+        self.assertIn('var selectedUser = "";', resp.data)
+
+    def test_memory_view(self):
+        """
+        Test memory report of worker.
+        """
+        utils.mycache.clear()
+        self.client.get('/api/v1/users')
+        resp = self.client.get('/api/v1/admin/memory')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        default = data['datasets']['default']
+        self.assertEqual(default['budget'], None)
+        self.assertItemsEqual(
+            default['cached']['presence_analyzer.utils.get_data'],
+            ['index', 'materialized', 'aggregates']
+        )
+        self.assertGreater(data['total'], 0)
+
+        resp = self.client.get('/api/v1/admin/memory',
+                               environ_base={'REMOTE_ADDR': '10.0.0.1'})
+        self.assertEqual(resp.status_code, 403)
+
     def test_view_users_data(self):
         """
         Test users data from xml data listing.
@@ -164,7 +463,7 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         Test parsing of CSV file.
         """
         data = utils.get_data()
-        self.assertIsInstance(data, dict)
+        self.assertIsInstance(data, utils.PresenceStore)
         self.assertItemsEqual(data.keys(), [10, 11])
         sample_date = datetime.date(2013, 9, 10)
         self.assertIn(sample_date, data[10])
@@ -172,6 +471,206 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         self.assertEqual(data[10][sample_date]['start'],
                          datetime.time(9, 39, 5))
 
+    def test_duplicate_rows(self):
+        """
+        Test if aggregates keep the last of duplicated rows, like users.
+        """
+        tempdir = tempfile.mkdtemp()
+        data_csv = os.path.join(tempdir, 'data.csv')
+        with open(data_csv, 'w') as csvfile:
+            csvfile.write(
+                '10,2013-09-10,09:00:00,17:00:00\n'
+                '10,2013-09-11,09:00:00,12:00:00\n'
+                '10,2013-09-10,09:00:00,10:00:00\n'
+            )
+        main.app.config.update({'DATA_CSV': data_csv})
+        utils.mycache.clear()
+        try:
+            data = utils.get_data()
+            self.assertEqual(data.entries(10), [(735121, 32400, 36000),
+                                                (735122, 32400, 43200)])
+            weekdays = utils.group_by_weekday(data[10])
+            totals = [sum(weekdays[day]) for day in range(7)]
+            self.assertEqual(totals, [0, 3600, 10800, 0, 0, 0, 0])
+
+            aggregates = data.aggregates
+            compared = aggregates['weekdays'].compare([10])
+            self.assertEqual(compared['total'], [totals])
+            self.assertEqual(compared['days'],
+                             [[len(weekdays[day]) for day in range(7)]])
+            self.assertEqual(compared['presence'], [totals])
+            self.assertEqual(aggregates['weekdays'].top('presence', 1, 1),
+                             [(10, 3600)])
+            self.assertEqual(aggregates['working_days'].means(10), totals)
+            self.assertEqual(
+                aggregates['distributions'].quantiles(10, 'presence',
+                                                      (0.9,))[1],
+                [3630]
+            )
+            self.assertEqual(aggregates['occupancy'].typical_day(10)[1][36],
+                             1)
+            self.assertEqual(aggregates['occupancy'].typical_day(10)[1][40],
+                             0)
+        finally:
+            main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+            utils.mycache.clear()
+            shutil.rmtree(tempdir)
+
+    def test_presence_store(self):
+        """
+        Test lazy materialization of users in presence store.
+        """
+        store = utils.PresenceStore({
+            10: [(735121, 34745, 64792)],
+            11: [(735116, 34088, 57087)],
+            12: [(735120, 33134, 57257)],
+        }, max_users=2)
+        self.assertItemsEqual(store.keys(), [10, 11, 12])
+        self.assertIn(10, store)
+        self.assertNotIn(13, store)
+        self.assertEqual(store.materialized(), [])
+
+        self.assertEqual(store[10], {
+            datetime.date(2013, 9, 10): {
+                'start': datetime.time(9, 39, 5),
+                'end': datetime.time(17, 59, 52),
+            },
+        })
+        store[11]
+        store[10]
+        store[12]
+        self.assertEqual(store.materialized(), [10, 12])
+        self.assertEqual(store.entries(11), [(735116, 34088, 57087)])
+        self.assertRaises(KeyError, lambda: store[13])
+
+    def test_compact_store(self):
+        """
+        Test if compacted presence store keeps its data.
+        """
+        store = utils.PresenceStore({
+            10: [(735121, 34745, 64792), (735122, 33134, 57257)],
+            11: [(735116, 34088, 57087)],
+        })
+        before = store[10]
+        usage = store.memory_usage()
+        self.assertEqual(store.materialized(), [10])
+
+        store.release()
+        store.compact()
+        self.assertEqual(store.materialized(), [])
+        self.assertLess(store.memory_usage()['index'], usage['index'])
+        self.assertEqual(store.memory_usage()['materialized'],
+                         utils.deep_size(utils.OrderedDict()))
+        self.assertEqual(store.entries(10),
+                         [(735121, 34745, 64792), (735122, 33134, 57257)])
+        self.assertEqual(store[10], before)
+
+    def test_deep_size(self):
+        """
+        Test estimation of memory used by nested objects.
+        """
+        item = 'x' * 1000
+        self.assertGreater(utils.deep_size([item]), 1000)
+        self.assertLess(utils.deep_size([item, item]), 2000)
+        self.assertGreater(utils.deep_size({'a': [item], 'b': (item + 'y',)}),
+                           2000)
+
+    def test_memory_budget(self):
+        """
+        Test if exceeded memory budget of dataset compacts its data.
+        """
+        warnings = []
+        warning = utils.log.warning
+        utils.log.warning = lambda *args: warnings.append(args)
+        main.app.config['DATASETS'] = {'krakow': {}}
+        krakow = main.app.test_request_context(
+            '/', environ_overrides={datasets.ENVIRON_KEY: 'krakow'}
+        )
+        key = 'presence_analyzer.utils.get_data'
+        utils.mycache.clear()
+        utils._files.clear()
+        try:
+            with krakow:
+                utils.get_data()[10]
+            utils.get_data()[10]
+            utils.read_user_data()
+            report = utils.memory_report()
+            self.assertEqual(sorted(report['datasets']), ['default', 'krakow'])
+            self.assertEqual(report['files'], {
+                TEST_DATA_XML: os.path.getsize(TEST_DATA_XML),
+            })
+            self.assertEqual(warnings, [])
+            default = report['datasets']['default']
+            self.assertEqual(default['budget'], None)
+            self.assertEqual(default['total'],
+                             sum(default['cached'][key].values()))
+            self.assertEqual(report['total'], sum(
+                dataset['total'] for dataset in report['datasets'].values()
+            ) + sum(report['files'].values()))
+
+            # only budget of krakow is exceeded
+            main.app.config['DATASETS']['krakow']['MEMORY_BUDGET'] = 1
+            with krakow:
+                utils.mycache.namespace('krakow').clear()
+                data = utils.get_data()
+                self.assertEqual(len(warnings), 2)
+                self.assertIsInstance(data._index[10], utils.array)
+            data = utils.get_data()
+            self.assertIsInstance(data._index[10], list)
+            self.assertEqual(data.materialized(), [10])
+
+            # compacting the reloaded store is enough
+            main.app.config['MEMORY_BUDGET'] = \
+                default['total'] - default['cached'][key]['materialized'] - 1
+            utils.mycache.namespace(None).clear()
+            data = utils.get_data()
+            self.assertEqual(len(warnings), 3)
+            self.assertIsInstance(data._index[10], utils.array)
+            self.assertEqual(utils.mycache.namespaces(), ['krakow', None])
+        finally:
+            utils.log.warning = warning
+            main.app.config.pop('MEMORY_BUDGET', None)
+            main.app.config.pop('DATASETS', None)
+            utils.mycache.clear()
+
+    def test_expired_values_released(self):
+        """
+        Test if expired values are not held nor reported.
+        """
+        main.app.config['DATASETS'] = {'krakow': {}}
+        key = 'presence_analyzer.utils.get_data'
+        utils.mycache.clear()
+        try:
+            with main.app.test_request_context(
+                    '/', environ_overrides={datasets.ENVIRON_KEY: 'krakow'}):
+                store = utils.get_data()
+            krakow = utils.mycache.namespace('krakow')
+            krakow.set(key, store, -1)
+            utils.get_data()
+            # storing data of default dataset purged expired krakow data
+            self.assertEqual(krakow._cache, {})
+
+            krakow.set(key, store, -1)
+            report = utils.memory_report()
+            self.assertEqual(report['datasets']['krakow']['total'], 0)
+            self.assertEqual(krakow._cache, {})
+        finally:
+            main.app.config.pop('DATASETS', None)
+            utils.mycache.clear()
+
+    def test_parse_date_time(self):
+        """
+        Test parsing of CSV dates and times.
+        """
+        self.assertEqual(utils.parse_date('2013-09-10'),
+                         datetime.date(2013, 9, 10).toordinal())
+        self.assertEqual(utils.parse_time('09:39:05'), 34745)
+        self.assertEqual(utils.seconds_to_time(34745),
+                         datetime.time(9, 39, 5))
+        self.assertRaises(ValueError, utils.parse_date, '2013-13-10')
+        self.assertRaises(ValueError, utils.parse_time, '24:00:00')
+        self.assertRaises(ValueError, utils.parse_time, '09:39')
+
     def test_group_by_weekday(self):
         """
         Test grouping items
@@ -248,6 +747,148 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         self.assertEqual(weekdays[5], [0, 0])
         self.assertEqual(weekdays[6], [0, 0])
 
+    def test_occupancy(self):
+        """
+        Test slot counts of occupancy difference arrays.
+        """
+        occupancy = stats.Occupancy()
+        tuesday = datetime.date(2013, 9, 10).toordinal()
+        occupancy.add(10, tuesday, 32400, 33300)
+        occupancy.add(11, tuesday, 32399, 33301)
+        occupancy.add(11, tuesday + 7, 32400, 32400)
+        occupancy.finish()
+
+        office = occupancy.typical_day()
+        self.assertEqual(len(office), 7)
+        self.assertEqual(len(office[1]), stats.SLOTS)
+        self.assertEqual(office[1][34:39], [0, 1, 2, 1, 0])
+        self.assertEqual(occupancy.typical_day(10)[1][34:39],
+                         [0, 0, 1, 0, 0])
+        self.assertEqual(occupancy.typical_day(12)[1][34:39],
+                         [0, 0, 0, 0, 0])
+        self.assertEqual(stats.slot_label(37), '09:15')
+
+    def test_bucket_sketch(self):
+        """
+        Test quantiles and merging of bucket sketches.
+        """
+        sketch = stats.BucketSketch(width=10)
+        self.assertEqual(sketch.quantile(0.5), 0)
+        for value in range(100):
+            sketch.add(value)
+        self.assertEqual(sketch.count, 100)
+        self.assertEqual(sketch.quantile(0.5), 45)
+        self.assertEqual(sketch.quantile(0.9), 85)
+        self.assertEqual(sketch.quantile(0), 5)
+
+        other = stats.BucketSketch(width=10)
+        for value in range(100, 200):
+            other.add(value)
+        sketch.merge(other)
+        self.assertEqual(sketch.count, 200)
+        self.assertEqual(sketch.quantile(0.5), 95)
+        self.assertRaises(ValueError, sketch.merge, stats.BucketSketch(5))
+
+    def test_distributions_merge(self):
+        """
+        Test if distributions of data chunks merge into whole data ones.
+        """
+        tuesday = datetime.date(2013, 9, 10).toordinal()
+        first = stats.Distributions()
+        first.add(10, tuesday, 32400, 61200)
+        second = stats.Distributions()
+        second.add(10, tuesday + 7, 36000, 54000)
+        second.add(10, tuesday + 14, 36000, 54000)
+        first.merge(second)
+        self.assertEqual(first.quantiles(10, 'start', (0.5, 0.9))[1],
+                         [36030, 36030])
+        self.assertEqual(first.quantiles(10, 'presence', (0.5, 0.9))[1],
+                         [18030, 28830])
+        self.assertEqual(first.quantiles(11, 'presence', (0.5,))[1], [0])
+
+    def test_weekday_aggregates(self):
+        """
+        Test matrices of means and heap selection of top users.
+        """
+        aggregates = stats.WeekdayAggregates()
+        tuesday = datetime.date(2013, 9, 10).toordinal()
+        aggregates.add(10, tuesday, 32400, 61200)
+        aggregates.add(10, tuesday + 1, 36000, 54000)
+        aggregates.add(11, tuesday, 28800, 50400)
+        aggregates.add(12, tuesday + 1, 30000, 60000)
+        aggregates.add(14, tuesday, 36000, 39600)
+        aggregates.add(14, tuesday + 7, 36000, 39600)
+        aggregates.finish()
+
+        self.assertEqual(aggregates.users, [10, 11, 12, 14])
+        self.assertEqual(list(aggregates.counts[:7]),
+                         [0, 1, 1, 0, 0, 0, 0])
+        self.assertEqual(list(aggregates.matrices['presence'][:7]),
+                         [0, 28800, 18000, 0, 0, 0, 0])
+        self.assertEqual(list(aggregates.overall['start']),
+                         [34200, 28800, 30000, 36000])
+        self.assertEqual(aggregates.top('presence', 2),
+                         [(12, 30000), (10, 23400)])
+        self.assertEqual(aggregates.top('start', 1, smallest=True),
+                         [(11, 28800)])
+        self.assertEqual(aggregates.top('presence', 5, day=1),
+                         [(10, 28800), (11, 21600), (14, 3600)])
+        self.assertEqual(aggregates.top('presence', 5, day=6), [])
+
+        compared = aggregates.compare([12, 13, 10])
+        self.assertEqual(compared['presence'], [
+            [0, 0, 30000, 0, 0, 0, 0],
+            [0] * 7,
+            [0, 28800, 18000, 0, 0, 0, 0],
+        ])
+        self.assertEqual(compared['days'][2], [0, 1, 1, 0, 0, 0, 0])
+        self.assertEqual(compared['total'][2], [0, 28800, 18000, 0, 0, 0, 0])
+        compared = aggregates.compare([14])
+        self.assertEqual(compared['presence'], [[0, 3600, 0, 0, 0, 0, 0]])
+        self.assertEqual(compared['total'], [[0, 7200, 0, 0, 0, 0, 0]])
+
+    def test_working_weekdays(self):
+        """
+        Test means of working days leaving out holidays and weekends.
+        """
+        thursday = datetime.date(2013, 9, 5).toordinal()
+        holiday = thursday + 6
+        aggregates = stats.WorkingWeekdays([holiday])
+        aggregates.add(10, thursday, 32400, 61200)
+        aggregates.add(10, thursday + 4, 32400, 54000)
+        aggregates.add(10, thursday + 11, 36000, 50400)
+        aggregates.add(10, thursday + 5, 32400, 61200)
+        aggregates.add(10, holiday, 36000, 54000)
+        aggregates.add(10, thursday + 9, 36000, 43200)
+        aggregates.add(11, thursday + 8, 28800, 57600)
+        aggregates.finish()
+
+        calendar = aggregates.calendar
+        self.assertEqual((calendar.first, calendar.last),
+                         (thursday, thursday + 11))
+        self.assertEqual(calendar.working_days, [2, 1, 0, 2, 2, 0, 0])
+        self.assertTrue(calendar.is_working(thursday + 5))
+        self.assertFalse(calendar.is_working(holiday))
+        self.assertFalse(calendar.is_working(thursday + 9))
+        self.assertEqual(calendar.working_days_between(thursday, thursday),
+                         [0, 0, 0, 1, 0, 0, 0])
+        self.assertEqual(
+            calendar.working_days_between(thursday + 1, thursday + 11),
+            [2, 1, 0, 1, 2, 0, 0]
+        )
+        self.assertEqual(aggregates.means(10),
+                         [18000, 28800, 0, 28800, 0, 0, 0])
+        self.assertEqual(aggregates.means(10, normalized=True),
+                         [18000, 28800, 0, 14400, 0, 0, 0])
+        # user 11 is normalized over own single day only
+        self.assertEqual(aggregates.means(11, normalized=True),
+                         [0, 0, 0, 0, 28800, 0, 0])
+        self.assertEqual(aggregates.means(12), [0] * 7)
+
+        aggregates = stats.WorkingWeekdays()
+        aggregates.finish()
+        self.assertEqual(aggregates.calendar.working_days, [0] * 7)
+
     def test_seconds_since_midnight(self):
         """
         Test calculating time
@@ -299,34 +940,1059 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
 
         self.assertEqual(type(xml_data), etree._ElementTree)
 
+    def test_setup_collation(self):
+        """
+        Test if missing collation locale does not break sorting.
+        """
+        main.app.config.update({'COLLATION_LOCALE': 'xx_XX.MISSING'})
+        del utils._collation_ready[:]
+        try:
+            utils.setup_collation()
+            self.assertEqual(utils._collation_ready, ['xx_XX.MISSING'])
+            utils.setup_collation()
+            self.assertEqual(utils._collation_ready, ['xx_XX.MISSING'])
+        finally:
+            del main.app.config['COLLATION_LOCALE']
+            del utils._collation_ready[:]
+
+    def test_import_times(self):
+        """
+        Test if heavy modules are not imported on startup.
+        """
+        times = script.import_times('presence_analyzer')
+        names = [name for own, cumulative, depth, name in times]
+        self.assertIn('presence_analyzer', names)
+        self.assertNotIn('lxml', names)
+        self.assertNotIn('lxml.etree', names)
+        self.assertNotIn('paste.script.command', names)
+
+        times = script.import_times('presence_analyzer.script')
+        names = [name for own, cumulative, depth, name in times]
+        self.assertNotIn('werkzeug.script', names)
+        self.assertNotIn('lxml', names)
+
     def test_cache(self):
         """
         Test if cache works.
         """
+        utils.mycache.clear()
         data_uncached = utils.get_data()
         os.rename(main.app.config['DATA_CSV'],
                   main.app.config['DATA_CSV']+"_bckp")
 
         try:
+            # check if cached data is retrieved corretly
             data_cached = utils.get_data()
-        except:
-            data_cached.clear()
+            self.assertIs(data_uncached, data_cached)
+
+            time.sleep(20)
 
-        # check if cached data is retrieved corretly
-        self.assertEqual(data_uncached, data_cached)
+            # check if unable to retrieve data after cache timeout
+            self.assertRaises(IOError, utils.get_data)
+        finally:
+            os.rename(main.app.config['DATA_CSV']+"_bckp",
+                      main.app.config['DATA_CSV'])
 
-        time.sleep(20)
+        # unchanged file is not loaded again
+        self.assertIs(utils.get_data(), data_uncached)
 
+    def test_data_reused(self):
+        """
+        Test if data is loaded again only when the file changes.
+        """
+        data_csv = main.app.config['DATA_CSV']
+        utils.mycache.clear()
         try:
-            data_cached = utils.get_data()
-        except:
-            data_cached.clear()
+            data = utils.get_data()
+            self.assertEqual(data[10][datetime.date(2013, 9, 10)]['start'],
+                             datetime.time(9, 39, 5))
+            # as if DATA_CHECK_INTERVAL passed
+            data.checked = 0
+            self.assertIs(utils.get_data(), data)
+            self.assertEqual(data.materialized(), [10])
+            self.assertGreater(data.checked, 0)
+
+            tempdir = tempfile.mkdtemp()
+            main.app.config['DATA_CSV'] = os.path.join(tempdir, 'data.csv')
+            shutil.copy(data_csv, main.app.config['DATA_CSV'])
+            self.assertIs(utils.get_data(), data)
+            data.checked = 0
+            reloaded = utils.get_data()
+            self.assertIsNot(reloaded, data)
+            self.assertEqual(reloaded.materialized(), [])
+            shutil.rmtree(tempdir)
+        finally:
+            main.app.config['DATA_CSV'] = data_csv
+            utils.mycache.clear()
+
+    def test_cache_keys(self):
+        """
+        Test if every cached function has its own cache entry.
+        """
+        utils.mycache.clear()
+
+        @utils.cache(20)
+        def first():
+            """
+            First cached function.
+            """
+            return 'first'
+
+        @utils.cache(20)
+        def second():
+            """
+            Second cached function.
+            """
+            return 'second'
+
+        self.assertEqual(first(), 'first')
+        self.assertEqual(second(), 'second')
+        utils.mycache.clear()
+
+
+class PresenceAnalyzerStressTestCase(unittest.TestCase):
+    """
+    Concurrency stress tests of cache and data loading.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tempdir = tempfile.mkdtemp()
+        self.data_csv = os.path.join(self.tempdir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, self.data_csv)
+        main.app.config.update({'DATA_CSV': self.data_csv})
+        main.app.config.update({'DATA_XML': TEST_DATA_XML})
+        utils.mycache.clear()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        utils.mycache.clear()
+        shutil.rmtree(self.tempdir)
+
+    def test_percentile(self):
+        """
+        Test nearest-rank percentile.
+        """
+        values = range(1, 101)
+        self.assertEqual(stress.percentile(values, 0.5), 50)
+        self.assertEqual(stress.percentile(values, 0.99), 99)
+        self.assertEqual(stress.percentile(values, 1), 100)
+        self.assertEqual(stress.percentile([], 0.99), 0)
+
+    def test_slow_loader_called_once(self):
+        """
+        Test if concurrent callers share a single slow load.
+        """
+        loader = stress.counting_loader(lambda: object(), delay=0.2)
+        cached = utils.cache(20)(loader)
+        results = []
+        result = stress.hammer(lambda: results.append(cached()),
+                               threads=16, calls=5)
+        self.assertEqual(result.errors, [])
+        self.assertEqual(result.calls, 80)
+        self.assertEqual(loader.calls, 1)
+        self.assertEqual(len(set(id(item) for item in results)), 1)
+
+    def test_no_torn_reads_under_reload(self):
+        """
+        Test if data replaced mid-read is never loaded partially.
+        """
+        with open(self.data_csv) as csvfile:
+            original = csvfile.read()
+        extended = original.rstrip('\n') + '\n' + self.user_rows(12, 500)
+        loaded = set()
+
+        # loads which never see the file unchanged fail, so the file is
+        # replaced less often than it takes to load it on a busy machine
+        with stress.rewriter(self.data_csv, [original, extended], 0.1):
+            with stress.reloader(0.03):
+                # until both versions were loaded, however slow the machine
+                for _ in range(50):
+                    result = stress.hammer(self.torn_read_checker(loaded),
+                                           threads=8, calls=20)
+                    self.assertEqual(result.errors, [])
+                    if loaded == set([2, 3]):
+                        break
+        self.assertEqual(loaded, set([2, 3]))
+
+    def test_no_torn_reads_under_rewrite_in_place(self):
+        """
+        Test if data modified in place mid-read is never loaded partially.
+        """
+        with open(self.data_csv) as csvfile:
+            original = csvfile.read()
+        extended = original.rstrip('\n') + '\n' + self.user_rows(12, 500)
+        loaded = set()
+        main.app.config['DATA_SETTLE_TIME'] = 0.1
+        try:
+            # writer pauses longer than settle time between versions
+            with stress.rewriter(self.data_csv, [original, extended], 0.15,
+                                 in_place=True, pieces=8, pause=0.002):
+                with stress.reloader(0.01):
+                    deadline = time.time() + 1.5
+                    while time.time() < deadline:
+                        result = stress.hammer(
+                            self.torn_read_checker(loaded),
+                            threads=4, calls=10
+                        )
+                        # with cache cleared so often a busy machine may
+                        # not see the file settle before first load
+                        self.assertEqual([
+                            error for error in result.errors
+                            if not isinstance(error, IOError)
+                        ], [])
+        finally:
+            main.app.config.pop('DATA_SETTLE_TIME', None)
+        self.assertTrue(loaded)
+        self.assertTrue(loaded <= set([2, 3]))
+
+    def user_rows(self, user_id, number):
+        """
+        Returns CSV rows of user present on given number of days.
+        """
+        first = datetime.date(2013, 9, 10).toordinal()
+        return ''.join(
+            '{0},{1},09:00:00,17:00:00\n'.format(
+                user_id, datetime.date.fromordinal(first + day).isoformat()
+            )
+            for day in range(number)
+        )
+
+    def torn_read_checker(self, loaded):
+        """
+        Returns function checking loaded data is one of written versions.
+        Numbers of users of loaded versions are added to loaded.
+        """
+        expected = (set([10, 11]), set([10, 11, 12]))
+
+        def read():
+            """
+            Loads data and checks it.
+            """
+            time.sleep(0.005)
+            data = utils.get_data()
+            loaded.add(len(data))
+            if set(data) not in expected:
+                raise AssertionError('Torn read: {0}'.format(set(data)))
+            if 12 in data and len(data.entries(12)) != 500:
+                raise AssertionError('Torn read of user 12')
+        return read
+
+    def test_data_modified_while_loading(self):
+        """
+        Test if data modified while being loaded is loaded again.
+        """
+        read_rows = utils.read_rows
+        calls = []
+
+        def modifying_read_rows(path):
+            """
+            Appends a row to the file while the first load reads it.
+            """
+            calls.append(path)
+            if len(calls) == 1:
+                time.sleep(0.01)
+                with open(path, 'a') as csvfile:
+                    csvfile.write('\n12,2013-09-10,09:00:00,17:00:00\n')
+            return read_rows(path)
+
+        utils.read_rows = modifying_read_rows
+        try:
+            data = utils.get_data()
+        finally:
+            utils.read_rows = read_rows
+        self.assertEqual(len(calls), 2)
+        self.assertIn(12, data)
+
+    def test_data_changing_on_every_load(self):
+        """
+        Test if data which never loads unchanged is not cached.
+        """
+        read_rows = utils.read_rows
+
+        def modifying_read_rows(path):
+            """
+            Appends a row to the file on every load.
+            """
+            with open(path, 'a') as csvfile:
+                csvfile.write('\n12,2013-09-10,09:00:00,17:00:00\n')
+            return read_rows(path)
+
+        data = utils.get_data()
+        utils.read_rows = modifying_read_rows
+        try:
+            data.checked = 0
+            self.assertIs(utils.get_data(), data)
+            self.assertNotIn(12, data)
+            utils.mycache.clear()
+            self.assertRaises(IOError, utils.get_data)
+        finally:
+            utils.read_rows = read_rows
+        self.assertIn(12, utils.get_data())
+
+    def test_settle_time(self):
+        """
+        Test counting settle time since signature was first seen.
+        """
+        path = os.path.join(self.tempdir, 'settle.csv')
+        # modified long ago, but just seen truncated
+        truncated = (1, time.time() - 100, 0)
+        first = utils.settle_time(path, truncated, 10)
+        self.assertGreater(first, 9)
+        time.sleep(0.01)
+        second = utils.settle_time(path, truncated, 10)
+        self.assertLess(second, first)
+        written = (1, time.time() - 100, 300)
+        self.assertGreater(utils.settle_time(path, written, 10), second)
+        self.assertLessEqual(utils.settle_time(path, written, 0), 0)
+
+    def test_previous_data_while_settling(self):
+        """
+        Test if previous data is served until modified file settles.
+        """
+        main.app.config['DATA_SETTLE_TIME'] = 0.2
+        try:
+            data = utils.get_data()
+            with open(self.data_csv, 'a') as csvfile:
+                csvfile.write('\n12,2013-09-10,09:00:00,17:00:00\n')
+            data.checked = 0
+            self.assertIs(utils.get_data(), data)
+            time.sleep(0.2)
+            self.assertIn(12, utils.get_data())
+        finally:
+            main.app.config.pop('DATA_SETTLE_TIME', None)
+
+    def test_views_under_processes(self):
+        """
+        Test views served concurrently by many processes.
+
+        Timing limits are left to bin/flask-ctl stress, as they depend
+        on the machine.
+        """
+        result = stress.hammer_processes('/api/v1/presence_weekday/10',
+                                         processes=2, threads=4, calls=25)
+        self.assertEqual(result.errors, [])
+        self.assertEqual(result.calls, 200)
+
+
+class PresenceAnalyzerDirectoryTestCase(unittest.TestCase):
+    """
+    User directory synchronization tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'users.xml')
+        self.content = USERS_XML.format(host='intranet', port=80)
+        self.server = start_stand_in({'/users.xml': (self.content, '"v1"')})
+        self.url = 'http://127.0.0.1:{0}/users.xml'.format(
+            self.server.server_port
+        )
+        main.app.config.update({'DATA_XML': self.path})
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        self.server.shutdown()
+        self.server.server_close()
+        main.app.config.update({'DATA_XML': TEST_DATA_XML})
+        shutil.rmtree(self.tempdir)
+
+    def test_sync_user_xml(self):
+        """
+        Test conditional download of changed directory only.
+        """
+        self.assertTrue(directory.sync_user_xml(self.url, self.path))
+        with open(self.path) as xml_file:
+            self.assertEqual(xml_file.read(), self.content)
+        self.assertEqual(directory.read_meta(self.path)['etag'], '"v1"')
+        tree = utils.read_user_data()
+
+        # not modified on the server
+        self.assertFalse(directory.sync_user_xml(self.url, self.path))
+        self.assertEqual(self.server.requests[-1][1]['if-none-match'],
+                         '"v1"')
+        self.assertIs(utils.read_user_data(), tree)
+
+        # reformatted, but the same users
+        reformatted = self.content.replace('\n        ', '\n    ')
+        self.server.files['/users.xml'] = (reformatted, '"v2"')
+        self.assertFalse(directory.sync_user_xml(self.url, self.path))
+        with open(self.path) as xml_file:
+            self.assertEqual(xml_file.read(), self.content)
+        self.assertEqual(directory.read_meta(self.path)['etag'], '"v2"')
+        self.assertIs(utils.read_user_data(), tree)
+
+        # the same users in different order
+        reordered = self.content.replace('141', '999').replace(
+            '176', '141').replace('999', '176')
+        self.server.files['/users.xml'] = (reordered, '"v3"')
+        self.assertTrue(directory.sync_user_xml(self.url, self.path))
+        with open(self.path) as xml_file:
+            self.assertEqual(xml_file.read(), reordered)
+        self.assertIsNot(utils.read_user_data(), tree)
+        self.assertEqual(sorted(os.listdir(self.tempdir)),
+                         ['users.xml', 'users.xml.meta'])
+
+    def test_content_hashes(self):
+        """
+        Test if duplicated users change directory hashes.
+        """
+        from lxml import etree
+        tree = etree.fromstring(self.content)
+        duplicated = etree.fromstring(self.content)
+        users = duplicated.find('users')
+        users.append(etree.fromstring(etree.tostring(users[0])))
+        hashes = directory.content_hashes(tree)
+        self.assertEqual(len(hashes), 3)
+        self.assertEqual(directory.content_hashes(duplicated)[:3], hashes)
+        self.assertNotEqual(directory.content_hashes(duplicated), hashes)
+
+
+class PresenceAnalyzerAvatarsTestCase(unittest.TestCase):
+    """
+    Avatar cache tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tempdir = tempfile.mkdtemp()
+        self.avatar_dir = os.path.join(self.tempdir, 'avatars')
+        self.png = '\x89PNG\r\n\x1a\n' + 'avatar'
+        self.server = start_stand_in({
+            '/api/images/users/141': (self.png, '"a141"'),
+        })
+        self.path = os.path.join(self.tempdir, 'users.xml')
+        with open(self.path, 'w') as xml_file:
+            xml_file.write(USERS_XML.format(host='127.0.0.1',
+                                            port=self.server.server_port))
+        main.app.config.update({'DATA_XML': self.path})
+        main.app.config.update({'AVATAR_DIR': self.avatar_dir})
+        self.client = main.app.test_client()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        self.server.shutdown()
+        self.server.server_close()
+        main.app.config.update({'DATA_XML': TEST_DATA_XML})
+        del main.app.config['AVATAR_DIR']
+        shutil.rmtree(self.tempdir)
+
+    def test_prefetch_avatars(self):
+        """
+        Test downloading avatars into content addressed cache.
+        """
+        tree = utils.read_user_data()
+        index = directory.prefetch_avatars(tree, self.avatar_dir, workers=2)
+        digest = hashlib.sha1(self.png).hexdigest()
+        self.assertEqual(index, {'141': {
+            'url': 'http://127.0.0.1:{0}/api/images/users/141'.format(
+                self.server.server_port),
+            'hash': digest,
+            'etag': '"a141"',
+        }})
+        self.assertEqual(sorted(os.listdir(self.avatar_dir)),
+                         [digest, 'index.json'])
+        self.assertEqual(directory.read_avatar_index(self.avatar_dir), index)
+
+        # unchanged avatar is not downloaded again
+        self.server.files['/api/images/users/176'] = ('GIF89a', None)
+        index = directory.prefetch_avatars(tree, self.avatar_dir, workers=2)
+        requests = dict(self.server.requests[-2:])
+        self.assertEqual(
+            requests['/api/images/users/141']['if-none-match'], '"a141"'
+        )
+        self.assertEqual(index['141']['hash'], digest)
+        self.assertEqual(len(index), 2)
+
+        # replaced avatar removes the old file
+        self.server.files['/api/images/users/141'] = ('GIF89a', '"b141"')
+        index = directory.prefetch_avatars(tree, self.avatar_dir, workers=2)
+        self.assertEqual(index['141']['hash'], index['176']['hash'])
+        self.assertEqual(sorted(os.listdir(self.avatar_dir)),
+                         [index['141']['hash'], 'index.json'])
+
+    def test_avatar_view(self):
+        """
+        Test serving cached avatars.
+        """
+        resp = self.client.get('/api/v1/users_data')
+        data = json.loads(resp.data)
+        self.assertEqual(data[0]['avatar'],
+                         'http://127.0.0.1:{0}/api/images/users/141'.format(
+                             self.server.server_port))
+
+        directory.prefetch_avatars(utils.read_user_data(), self.avatar_dir)
+        resp = self.client.get('/api/v1/users_data')
+        data = json.loads(resp.data)
+        digest = hashlib.sha1(self.png).hexdigest()
+        self.assertEqual(data[0]['avatar'], '/avatars/' + digest)
+        self.assertTrue(data[1]['avatar'].startswith('http://127.0.0.1'))
+
+        resp = self.client.get('/avatars/' + digest)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'image/png')
+        self.assertEqual(resp.data, self.png)
+        self.assertEqual(resp.headers['ETag'], '"{0}"'.format(digest))
+        self.assertIn('max-age=31536000', resp.headers['Cache-Control'])
+
+        resp = self.client.get('/avatars/' + digest, headers={
+            'If-None-Match': '"{0}"'.format(digest),
+        })
+        self.assertEqual(resp.status_code, 304)
+
+        resp = self.client.get('/avatars/' + '0' * 40)
+        self.assertEqual(resp.status_code, 404)
+        resp = self.client.get('/avatars/index.json')
+        self.assertEqual(resp.status_code, 404)
+
+
+class PresenceAnalyzerDatasetsTestCase(unittest.TestCase):
+    """
+    Multiple datasets tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tempdir = tempfile.mkdtemp()
+        krakow_csv = os.path.join(self.tempdir, 'krakow.csv')
+        with open(krakow_csv, 'w') as csvfile:
+            csvfile.write('20,2013-09-10,09:00:00,17:00:00\n')
+        main.app.config.update({
+            'DATA_CSV': TEST_DATA_CSV,
+            'DATA_XML': TEST_DATA_XML,
+            'DATASETS': {
+                'krakow': {
+                    'DATA_CSV': krakow_csv,
+                    'PRESENCE_CACHE_USERS': 1,
+                },
+                'gdansk': {},
+            },
+        })
+        utils.mycache.clear()
+        self.client = main.app.test_client()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        del main.app.config['DATASETS']
+        main.app.config.pop('DATASET_LIMIT', None)
+        utils.mycache.clear()
+        shutil.rmtree(self.tempdir)
+
+    def users(self, url, **kwargs):
+        """
+        Returns ids of users listed by url.
+        """
+        resp = self.client.get(url, **kwargs)
+        self.assertEqual(resp.status_code, 200)
+        return [user['user_id'] for user in json.loads(resp.data)]
+
+    def test_avatar_dirs(self):
+        """
+        Test if datasets keep their avatars apart.
+        """
+        avatars = os.path.join(self.tempdir, 'avatars')
+        main.app.config['AVATAR_DIR'] = avatars
+        try:
+            self.assertEqual(directory.avatar_dir(None), avatars)
+            self.assertEqual(directory.avatar_dir('krakow'),
+                             os.path.join(avatars, 'krakow'))
+            directory.check_avatar_dirs()
+
+            for name, digest in ((None, 'a' * 40), ('krakow', 'b' * 40)):
+                path = directory.avatar_dir(name)
+                os.makedirs(path)
+                with open(os.path.join(path, digest), 'w') as avatar_file:
+                    avatar_file.write('avatar')
+                with open(directory.avatar_index_path(path), 'w') as index:
+                    json.dump({'141': {'url': '', 'hash': digest}}, index)
+
+            for prefix, digest in (('', 'a' * 40), ('/krakow', 'b' * 40)):
+                resp = self.client.get(prefix + '/api/v1/users_data')
+                users = json.loads(resp.data)
+                self.assertEqual(users[0]['avatar'],
+                                 prefix + '/avatars/' + digest)
+                resp = self.client.get(prefix + '/avatars/' + digest)
+                self.assertEqual(resp.status_code, 200)
+            resp = self.client.get('/krakow/avatars/' + 'a' * 40)
+            self.assertEqual(resp.status_code, 404)
+
+            main.app.config['DATASETS']['gdansk']['AVATAR_DIR'] = avatars
+            self.assertRaises(ValueError, directory.check_avatar_dirs)
+        finally:
+            del main.app.config['AVATAR_DIR']
+
+    def test_select_dataset(self):
+        """
+        Test selecting dataset by URL prefix and header.
+        """
+        self.assertEqual(self.users('/krakow/api/v1/users'), [20])
+        self.assertEqual(self.users('/api/v1/users'), [10, 11])
+        self.assertEqual(self.users('/gdansk/api/v1/users'), [10, 11])
+        self.assertEqual(
+            self.users('/api/v1/users', headers={'X-Dataset': 'krakow'}),
+            [20]
+        )
+        self.assertEqual(utils.mycache.namespaces(),
+                         [None, 'gdansk', 'krakow'])
+
+        resp = self.client.get('/api/v1/users',
+                               headers={'X-Dataset': 'warsaw'})
+        self.assertEqual(resp.status_code, 404)
+        resp = self.client.get('/warsaw/api/v1/users')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_dataset_urls(self):
+        """
+        Test if pages of dataset link to its own API.
+        """
+        resp = self.client.get('/krakow/')
+        self.assertEqual(resp.status_code, 302)
+        assert resp.headers['Location'].endswith(
+            '/krakow/presence_weekday.html'
+        )
+        resp = self.client.get('/krakow/presence_weekday.html')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('"/krakow/api/v1/presence_weekday/"', resp.data)
+
+    def test_evict_idle_datasets(self):
+        """
+        Test if least recently used datasets are evicted from cache.
+        """
+        main.app.config.update({'DATASET_LIMIT': 2})
+        self.users('/krakow/api/v1/users')
+        self.users('/api/v1/users')
+        self.client.get('/krakow/api/v1/presence_weekday/20')
+        self.users('/gdansk/api/v1/users')
+        self.assertEqual(utils.mycache.namespaces(), ['krakow', 'gdansk'])
+
+    def test_dataset_settings(self):
+        """
+        Test if dataset settings override application ones.
+        """
+        with main.app.test_request_context(
+                '/', environ_overrides={datasets.ENVIRON_KEY: 'krakow'}):
+            self.assertEqual(datasets.current_dataset(), 'krakow')
+            self.assertEqual(datasets.setting('DATA_CSV'),
+                             os.path.join(self.tempdir, 'krakow.csv'))
+            self.assertEqual(datasets.setting('DATA_XML'), TEST_DATA_XML)
+            self.assertEqual(datasets.setting('MISSING', 5), 5)
+        self.assertIsNone(datasets.current_dataset())
+        self.assertEqual(
+            datasets.settings('krakow')['PRESENCE_CACHE_USERS'], 1
+        )
+        self.assertEqual(datasets.settings(None)['DATA_CSV'], TEST_DATA_CSV)
+
+
+class PresenceAnalyzerValidateTestCase(unittest.TestCase):
+    """
+    Presence data validation tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tempdir = tempfile.mkdtemp()
+        self.input = os.path.join(self.tempdir, 'data.csv')
+        self.output = os.path.join(self.tempdir, 'data.clean.bin')
+        self.report = os.path.join(self.tempdir, 'data.report.csv')
+        self.checkpoint = os.path.join(self.tempdir, 'data.checkpoint')
+        with open(self.input, 'w') as csvfile:
+            csvfile.write(
+                'user_id,date,start,end\n'
+                '10,2013-09-10,09:39:05,17:59:52\n'
+                '10,2013-09-11,09:19:52,16:07:37\n'
+                '10,2013-09-11,09:00:00,16:00:00\n'
+                'x,2013-09-12,09:00:00,16:00:00\n'
+                '11,2013-09-12,17:00:00,09:00:00\n'
+                '\n'
+                '11,2013-09-13,09:00:00,09:00:00\n'
+                '11,2013-09-14,01:00:00,23:00:00\n'
+                '11,2013-09-05,09:28:08,15:51:27\n'
+            )
+        utils.mycache.clear()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        utils.mycache.clear()
+        shutil.rmtree(self.tempdir)
+
+    def run_validate(self, output=None, chunk_size=2):
+        """
+        Validates input file with small chunks.
+        """
+        return validate.validate(self.input, output or self.output,
+                                 self.report, self.checkpoint, chunk_size)
+
+    def test_validate(self):
+        """
+        Test flagging anomalies and writing cleaned rows.
+        """
+        counts = self.run_validate()
+        self.assertEqual(counts, {
+            'rows': 9,
+            'clean': 3,
+            'malformed': 2,
+            'end_before_start': 1,
+            'duplicate': 1,
+            'duration': 2,
+        })
+        with open(self.report) as report:
+            self.assertEqual(
+                [row[:2] for row in csv.reader(report)],
+                [['1', 'malformed'], ['4', 'duplicate'], ['5', 'malformed'],
+                 ['6', 'end_before_start'], ['8', 'duration'],
+                 ['9', 'duration']]
+            )
+        # duplicates are kept after the row they repeat
+        self.assertEqual([row[0] for row in utils.read_rows(self.output)],
+                         [10, 10, 10, 11])
+
+        # the last of duplicated rows is loaded, like from the input
+        main.app.config.update({'DATA_CSV': self.output})
+        data = utils.get_data()
+        self.assertItemsEqual(data.keys(), [10, 11])
+        self.assertEqual(data[10][datetime.date(2013, 9, 11)]['start'],
+                         datetime.time(9, 0, 0))
+        main.app.config.update({'DATA_CSV': self.input})
+        utils.mycache.clear()
+        self.assertEqual(
+            utils.get_data()[10][datetime.date(2013, 9, 11)]['start'],
+            datetime.time(9, 0, 0)
+        )
+
+    def test_validate_csv_output(self):
+        """
+        Test writing cleaned rows as CSV.
+        """
+        output = os.path.join(self.tempdir, 'data.clean.csv')
+        self.run_validate(output)
+        with open(output) as csvfile:
+            self.assertEqual(csvfile.read().splitlines(), [
+                '10,2013-09-10,09:39:05,17:59:52',
+                '10,2013-09-11,09:19:52,16:07:37',
+                '10,2013-09-11,09:00:00,16:00:00',
+                '11,2013-09-05,09:28:08,15:51:27',
+            ])
+
+    def test_validate_resume(self):
+        """
+        Test resuming validation after interruption and new rows.
+        """
+        self.run_validate()
+        with open(self.output) as binfile:
+            clean = binfile.read()
+        # partial writes of an interrupted run are dropped
+        with open(self.output, 'a') as binfile:
+            binfile.write('garbage')
+        with open(self.report, 'a') as report:
+            report.write('garbage')
+        with open(self.input, 'a') as csvfile:
+            csvfile.write('10,2013-09-10,10:00:00,17:00:00\n'
+                          '12,2013-09-10,10:00:00,17:00:00\n')
+
+        counts = self.run_validate()
+        self.assertEqual(counts['rows'], 11)
+        self.assertEqual(counts['clean'], 4)
+        self.assertEqual(counts['duplicate'], 2)
+        with open(self.output) as binfile:
+            self.assertTrue(binfile.read().startswith(clean))
+        self.assertEqual([row[0] for row in utils.read_rows(self.output)],
+                         [10, 10, 10, 11, 10, 12])
+        with open(self.report) as report:
+            rows = list(csv.reader(report))
+        self.assertEqual(rows[-1][:2], ['11', 'duplicate'])
+        self.assertEqual(len(rows), 7)
+
+        # nothing new to validate
+        self.assertEqual(self.run_validate(), counts)
+
+    def test_validate_lost_output(self):
+        """
+        Test starting over when output or report file was lost.
+        """
+        counts = self.run_validate(chunk_size=3)
+        with open(self.output) as binfile:
+            clean = binfile.read()
+        with open(self.report) as report:
+            flagged = report.read()
+
+        os.remove(self.output)
+        self.assertEqual(self.run_validate(chunk_size=3), counts)
+        with open(self.output) as binfile:
+            self.assertEqual(binfile.read(), clean)
+
+        with open(self.report, 'w') as report:
+            report.write(flagged[:10])
+        self.assertEqual(self.run_validate(chunk_size=3), counts)
+        with open(self.report) as report:
+            self.assertEqual(report.read(), flagged)
+
+
+class PresenceAnalyzerThrottleTestCase(unittest.TestCase):
+    """
+    Rate limiting and request coalescing tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        main.app.config.update({'DATA_XML': TEST_DATA_XML})
+        throttle.limiter.clear()
+        self.client = main.app.test_client()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.config.pop('RATE_LIMIT', None)
+        throttle.limiter.clear()
+
+    def test_token_bucket(self):
+        """
+        Test consuming and refilling tokens.
+        """
+        now = [100.0]
+        bucket = throttle.TokenBucket(2, 3, clock=lambda: now[0])
+        self.assertEqual([bucket.consume() for _ in range(4)],
+                         [True, True, True, False])
+        self.assertEqual(bucket.retry_after(), 0.5)
+        now[0] += 0.5
+        self.assertTrue(bucket.consume())
+        self.assertFalse(bucket.consume())
+        now[0] += 100
+        self.assertEqual([bucket.consume() for _ in range(4)],
+                         [True, True, True, False])
+
+    def test_rate_limit(self):
+        """
+        Test rejecting requests over the rate limit of client.
+        """
+        main.app.config.update({'RATE_LIMIT': (0.1, 2)})
+        self.assertEqual(self.client.get('/api/v1/users').status_code, 200)
+        self.assertEqual(self.client.get('/api/v1/users').status_code, 200)
+        resp = self.client.get('/api/v1/users')
+        self.assertEqual(resp.status_code, 429)
+        self.assertEqual(resp.headers['Retry-After'], '10')
+        resp = self.client.get('/static/css/style.css')
+        self.assertEqual(resp.status_code, 200)
+
+        resp = self.client.get('/api/v1/users',
+                               environ_base={'REMOTE_ADDR': '10.0.0.2'})
+        self.assertEqual(resp.status_code, 200)
+
+    def test_rate_limit_datasets(self):
+        """
+        Test limiting rate of client separately in every dataset.
+        """
+        main.app.config.update({
+            'RATE_LIMIT': (0.1, 1),
+            'DATASETS': {'krakow': {'RATE_LIMIT': (0.1, 2)}},
+        })
+        try:
+            self.assertEqual(self.client.get('/api/v1/users').status_code,
+                             200)
+            self.assertEqual(self.client.get('/api/v1/users').status_code,
+                             429)
+            for _ in range(2):
+                resp = self.client.get('/krakow/api/v1/users')
+                self.assertEqual(resp.status_code, 200)
+            resp = self.client.get('/krakow/api/v1/users')
+            self.assertEqual(resp.status_code, 429)
+        finally:
+            main.app.config.pop('DATASETS', None)
+
+    def test_coalesce(self):
+        """
+        Test sharing single computation between identical requests.
+        """
+        calls = []
+        started = threading.Event()
+
+        @throttle.coalesce
+        @utils.jsonify
+        def slow_view():
+            """
+            Slow view counting its calls.
+            """
+            calls.append(1)
+            number = len(calls)
+            started.set()
+            time.sleep(0.2)
+            return [['Mon', number]]
+
+        responses = []
+
+        def request(url, base_url=None):
+            """
+            Calls view in context of request for url.
+            """
+            with main.app.test_request_context(url, base_url):
+                responses.append(((base_url or '') + url, slow_view()))
+
+        threads = [threading.Thread(target=request, args=('/api/v1/x',))]
+        threads[0].start()
+        started.wait()
+        threads += [threading.Thread(target=request, args=('/api/v1/x',))
+                    for _ in range(7)]
+        threads.append(threading.Thread(target=request,
+                                        args=('/api/v1/x?n=2',)))
+        # links in response depend on URL prefix of the request
+        threads.append(threading.Thread(
+            target=request, args=('/api/v1/x', 'http://localhost/krakow/')
+        ))
+        for thread in threads[1:]:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 3)
+        shared = [resp for url, resp in responses if url == '/api/v1/x']
+        self.assertEqual(len(shared), 8)
+        self.assertEqual(len(set(id(resp) for resp in shared)), 8)
+        self.assertEqual(set(resp.data for resp in shared),
+                         set(['[["Mon",1]]']))
+        self.assertEqual(shared[-1].content_type, 'application/json')
+        self.assertEqual(throttle._flights, {})
+
+    def test_coalesce_errors(self):
+        """
+        Test if failed computation does not stay in flight.
+        """
+        resp = self.client.get('/api/v1/top/lunch')
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(throttle._flights, {})
+
+
+class PresenceAnalyzerSerializersTestCase(unittest.TestCase):
+    """
+    JSON serializers tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        main.app.config.update({'DATA_XML': TEST_DATA_XML})
+        self.client = main.app.test_client()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.config.pop('JSON_SERIALIZER', None)
 
-        #check if unable to retrieve data after cache timeout
-        self.assertNotEqual(data_uncached, data_cached)
+    def test_dumps(self):
+        """
+        Test if every installed serializer encodes like json module.
+        """
+        for name in serializers.BACKENDS:
+            try:
+                serializer = serializers.get_serializer(name)
+            except ValueError:
+                continue
+            for data in serializers.samples().values() + [
+                    [], {'a': [1, 2.5]}, [(u'\u015b', 0), (u'a', 1)]]:
+                self.assertEqual(json.loads(serializer.dumps(data)),
+                                 json.loads(json.dumps(data)))
+        self.assertEqual(
+            serializers.get_serializer('json').dumps([['Mon', 0.5]]),
+            '[["Mon",0.5]]'
+        )
 
-        os.rename(main.app.config['DATA_CSV']+"_bckp",
-                  main.app.config['DATA_CSV'])
+    def test_iterdumps(self):
+        """
+        Test if streamed JSON lists are complete in every batch size.
+        """
+        serializer = serializers.get_serializer('json')
+        items = [{'user_id': user_id} for user_id in range(5)]
+        for batch in (1, 2, 5, 10):
+            parts = list(serializer.iterdumps(iter(items), batch))
+            self.assertEqual(json.loads(''.join(parts)), items)
+        self.assertEqual(list(serializer.iterdumps([])), ['[]'])
+        self.assertEqual(len(list(serializer.iterdumps(items, 2))), 4)
+
+    def test_get_serializer(self):
+        """
+        Test selection of serializer.
+        """
+        main.app.config['JSON_SERIALIZER'] = 'json'
+        self.assertEqual(serializers.get_serializer().name, 'json')
+        self.assertIs(serializers.get_serializer(),
+                      serializers.get_serializer('json'))
+        self.assertIn(serializers.get_serializer(None).name,
+                      serializers.BACKENDS)
+        self.assertRaises(ValueError, serializers.get_serializer, 'yaml')
+
+    def test_check_floats(self):
+        """
+        Test rejecting serializers which round floats.
+        """
+        serializers.check_floats('json', json.dumps)
+        self.assertRaises(ValueError, serializers.check_floats, 'rounding',
+                          lambda obj: json.dumps([round(obj[0], 10)]))
+        self.assertRaises(ValueError, serializers.check_floats, 'failing',
+                          lambda obj: '[0]')
+
+    def test_streamed_view(self):
+        """
+        Test if only views returning iterators are streamed.
+        """
+        main.app.config['JSON_SERIALIZER'] = 'json'
+        items = [{u'user_id': 10}, {u'user_id': 11}]
+        with main.app.test_request_context('/'):
+            resp = utils.jsonify(lambda: (item for item in items))()
+            self.assertTrue(resp.is_streamed)
+            self.assertEqual(resp.content_type, 'application/json')
+            self.assertEqual(json.loads(resp.get_data()), items)
+
+            for result in ('ok', 5, 2.5, None, items, tuple(items),
+                           {u'a': [1]}):
+                resp = utils.jsonify(lambda: result)()
+                self.assertFalse(resp.is_streamed)
+                self.assertEqual(json.loads(resp.get_data()),
+                                 json.loads(json.dumps(result)))
+
+        # listing of users is not streamed, so it may be coalesced
+        resp = self.client.get('/api/v1/users')
+        self.assertIn('Content-Length', resp.headers)
+        self.assertItemsEqual(json.loads(resp.data), [
+            {u'user_id': 10, u'name': u'User 10'},
+            {u'user_id': 11, u'name': u'User 11'},
+        ])
+
+    def test_benchmark(self):
+        """
+        Test if benchmark measures json.dumps and installed serializers.
+        """
+        results = serializers.benchmark(number=1)
+        self.assertEqual(results.keys()[0], 'json.dumps')
+        self.assertIn('json', results)
+        for timings in results.values():
+            self.assertItemsEqual(timings, serializers.samples())
 
 
 def suite():
@@ -336,6 +2002,13 @@ def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(PresenceAnalyzerViewsTestCase))
     suite.addTest(unittest.makeSuite(PresenceAnalyzerUtilsTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerStressTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerDirectoryTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerAvatarsTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerDatasetsTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerValidateTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerThrottleTestCase))
+    suite.addTest(unittest.makeSuite(PresenceAnalyzerSerializersTestCase))
     return suite
 
 
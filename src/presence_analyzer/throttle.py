@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Rate limiting and coalescing of identical concurrent requests.
+"""
+
+import math
+import time
+import threading
+from functools import wraps
+from collections import OrderedDict
+
+from flask import Response, request
+
+from presence_analyzer.main import app
+from presence_analyzer.datasets import current_dataset, setting
+
+
+class TokenBucket(object):
+    """
+    Token bucket refilled with `rate` tokens per second up to `burst`.
+    """
+
+    def __init__(self, rate, burst, clock=time.time):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self._clock = clock
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def consume(self):
+        """
+        Takes a token, returns False when there is none left.
+        """
+        with self._lock:
+            now = self._clock()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+    def retry_after(self):
+        """
+        Returns seconds until next token is available.
+        """
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class RateLimiter(object):
+    """
+    Token buckets of clients, at most `max_clients` most recent ones.
+    """
+
+    def __init__(self, max_clients=10000):
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def bucket(self, client, rate, burst):
+        """
+        Returns bucket of client, creating a full one for new clients.
+        """
+        with self._lock:
+            try:
+                bucket = self._buckets.pop(client)
+            except KeyError:
+                bucket = TokenBucket(rate, burst)
+            self._buckets[client] = bucket
+            while len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        return bucket
+
+    def clear(self):
+        """
+        Forgets all clients.
+        """
+        with self._lock:
+            self._buckets.clear()
+
+
+limiter = RateLimiter()  # pylint: disable-msg=C0103
+
+
+@app.before_request
+def limit_rate():
+    """
+    Rejects requests of clients exceeding RATE_LIMIT.
+
+    RATE_LIMIT is a (requests per second, burst) tuple, rate is not
+    limited when it is not set. Static files are never limited.
+    Every dataset has its own buckets, as it may have its own limit.
+    """
+    limit = setting('RATE_LIMIT')
+    if not limit or request.endpoint == 'static':
+        return None
+    bucket = limiter.bucket((current_dataset(), request.remote_addr),
+                            *limit)
+    if bucket.consume():
+        return None
+    response = Response('Too many requests', 429, mimetype='text/plain')
+    response.headers['Retry-After'] = str(int(math.ceil(
+        bucket.retry_after()
+    )))
+    return response
+
+
+class Flight(object):
+    """
+    Computation of response shared by identical concurrent requests.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_flights = {}  # pylint: disable-msg=C0103
+_flights_lock = threading.Lock()  # pylint: disable-msg=C0103
+
+
+def coalesce(function):
+    """
+    Shares single call of wrapped view between identical concurrent
+    requests.
+
+    The first request computes the response, requests for the same URL
+    of the same dataset arriving meanwhile wait for it and get copies of
+    its serialized body, status and headers. Streamed responses are not
+    shared, waiting requests compute their own then. The URL includes
+    host and dataset prefix, as links built by url_for depend on them.
+    """
+    @wraps(function)
+    def inner(*args, **kwargs):
+        """
+        Joins in-flight computation or starts a new one.
+        """
+        key = (current_dataset(), request.method, request.url)
+        with _flights_lock:
+            flight = _flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _flights[key] = Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            if flight.result is not None:
+                body, status, headers = flight.result
+                return Response(body, status, headers)
+            return function(*args, **kwargs)
+
+        try:
+            response = function(*args, **kwargs)
+            if not response.is_streamed:
+                flight.result = (response.get_data(), response.status_code,
+                                 response.headers.to_wsgi_list())
+            return response
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            with _flights_lock:
+                del _flights[key]
+            flight.done.set()
+    return inner
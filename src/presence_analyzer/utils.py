@@ -3,47 +3,191 @@
 Helper functions used in views.
 """
 
+import os
+import sys
 import csv
-from json import dumps
+import time
+import tempfile
 from functools import wraps
-from datetime import datetime
+from array import array
+from datetime import date, time as dtime
+from collections import Iterator, Mapping, OrderedDict
 
 from flask import Response
 
 from presence_analyzer.main import app
-
-from werkzeug.contrib.cache import SimpleCache
+from presence_analyzer.stats import new_aggregates, WORKING_WEEKDAYS
+from presence_analyzer.datasets import current_dataset, setting, settings
+from presence_analyzer.serializers import get_serializer
 
 import threading
 
+import locale
 import logging
 
-from lxml import etree
-
 log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
 
-mycache = SimpleCache()  # pylint: disable-msg=C0103
+BINARY_EXTENSION = '.bin'
+BINARY_MAGIC = 'PAB1'
+LOAD_ATTEMPTS = 5
+DATA_KEY = 'presence_analyzer.utils.get_data'
+DATA_CHECK_INTERVAL = 20
+
+
+class LocalCache(object):
+    """
+    In-process cache keeping values by reference.
+
+    Unlike werkzeug's SimpleCache it does not pickle values, so objects
+    like PresenceStore keep their state between requests.
+    """
+
+    def __init__(self):
+        self._cache = {}
+
+    def get(self, key):
+        """
+        Returns cached value or None if missing or expired.
+        """
+        try:
+            expires, value = self._cache[key]
+        except KeyError:
+            return None
+        if expires <= time.time():
+            self._cache.pop(key, None)
+            return None
+        return value
+
+    def set(self, key, value, timeout):
+        """
+        Stores value for given amount of seconds, without timeout
+        until it is replaced or cleared.
+        """
+        expires = float('inf') if timeout is None else time.time() + timeout
+        self._cache[key] = (expires, value)
+
+    def items(self):
+        """
+        Returns (key, value) pairs of values which did not expire.
+        """
+        self.purge()
+        return [(key, value) for key, (_, value) in self._cache.items()]
+
+    def purge(self):
+        """
+        Removes expired values, which are otherwise kept until their key
+        is read again.
+        """
+        now = time.time()
+        for key, (expires, _) in self._cache.items():
+            if expires <= now:
+                self._cache.pop(key, None)
+
+    def clear(self):
+        """
+        Removes all cached values.
+        """
+        self._cache.clear()
+
+
+class DatasetCache(object):
+    """
+    Separate LocalCache namespace for every dataset.
+
+    Values are stored in the namespace of dataset of current request.
+    At most DATASET_LIMIT namespaces are kept, the whole namespace
+    of the least recently used dataset is dropped when it is exceeded.
+    Memory of every namespace is limited by MEMORY_BUDGET setting of its
+    dataset, see enforce_memory_budget. Storing a value purges expired
+    values of all datasets, so idle datasets do not hold on to them.
+    """
+
+    def __init__(self):
+        self._namespaces = OrderedDict()
+        self._lock = threading.Lock()
+
+    def namespace(self, name):
+        """
+        Returns cache of given dataset, marking it as recently used.
+        """
+        with self._lock:
+            try:
+                namespace = self._namespaces.pop(name)
+            except KeyError:
+                namespace = LocalCache()
+            self._namespaces[name] = namespace
+            limit = app.config.get('DATASET_LIMIT', 4)
+            while len(self._namespaces) > limit:
+                evicted, _ = self._namespaces.popitem(last=False)
+                log.debug('Dataset %s evicted from cache', evicted)
+        return namespace
+
+    def namespaces(self):
+        """
+        Returns names of cached datasets, most recently used last.
+        """
+        with self._lock:
+            return list(self._namespaces)
+
+    def items(self):
+        """
+        Returns (name, cache) pairs of datasets, most recently used last.
+        """
+        with self._lock:
+            return list(self._namespaces.items())
+
+    def get(self, key):
+        """
+        Returns value cached for current dataset.
+        """
+        return self.namespace(current_dataset()).get(key)
+
+    def set(self, key, value, timeout):
+        """
+        Caches value for current dataset.
+        """
+        self.namespace(current_dataset()).set(key, value, timeout)
+        for _, namespace in self.items():
+            namespace.purge()
+
+    def clear(self):
+        """
+        Drops caches of all datasets.
+        """
+        with self._lock:
+            self._namespaces.clear()
+
+
+mycache = DatasetCache()  # pylint: disable-msg=C0103
 
 
 def cache(timeout=6):
     """
-    Caches user data.
+    Caches result of wrapped function.
+
+    Every wrapped function has its own cache key in every dataset,
+    concurrent callers wait for a single call of wrapped function
+    when cache is empty.
     """
     def wrap(wrapped_func):
         """
         Outer wrapper of cache.
         """
-        lock = threading.Lock()
+        locks = {}
+        key = '{0}.{1}'.format(wrapped_func.__module__, wrapped_func.__name__)
 
+        @wraps(wrapped_func)
         def wrapped():
             """
             Inner wrapper of cache.
             """
-            with lock:
-                response = mycache.get(1)
-                if response is None:
-                    response = wrapped_func()
-                    mycache.set(1, wrapped_func(), timeout)
+            response = mycache.get(key)
+            if response is None:
+                with locks.setdefault(current_dataset(), threading.Lock()):
+                    response = mycache.get(key)
+                    if response is None:
+                        response = wrapped_func()
+                        mycache.set(key, response, timeout)
             return response
         return wrapped
     return wrap
@@ -52,23 +196,186 @@ def cache(timeout=6):
 def jsonify(function):
     """
     Creates a response with the JSON representation of wrapped function result.
+
+    Iterators, like generators, are streamed as JSON lists.
     """
     @wraps(function)
     def inner(*args, **kwargs):
         """
         Returns response result
         """
-        return Response(dumps(function(*args, **kwargs)),
+        result = function(*args, **kwargs)
+        serializer = get_serializer()
+        if isinstance(result, Iterator):
+            return Response(serializer.iterdumps(result),
+                            mimetype='application/json')
+        return Response(serializer.dumps(result),
                         mimetype='application/json')
     return inner
 
 
-@cache(20)
+class PresenceStore(Mapping):
+    """
+    Presence data of all users, materialized per user on first access.
+
+    Keeps a compact index of (date ordinal, start seconds, end seconds)
+    tuples for every user and builds the date/time structure returned
+    by get_data only for users actually requested. At most max_users
+    materialized users are kept, least recently used ones are dropped.
+    Aggregates computed while loading are available by name in
+    `aggregates`.
+
+    When memory is short the index may be compacted further into flat
+    integer arrays, see enforce_memory_budget. `signature` is the
+    file_signature of loaded file and `checked` the time it was last
+    compared with the file.
+    """
+
+    def __init__(self, index, max_users=100, aggregates=None,
+                 signature=None):
+        self._index = index
+        self.aggregates = aggregates or {}
+        self.signature = signature
+        self.checked = time.time()
+        self._max_users = max_users
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getitem__(self, user_id):
+        with self._lock:
+            try:
+                items = self._users.pop(user_id)
+            except KeyError:
+                items = materialize(unpack(self._index[user_id]))
+            self._users[user_id] = items
+            while len(self._users) > self._max_users:
+                self._users.popitem(last=False)
+        return items
+
+    def __contains__(self, user_id):
+        return user_id in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def entries(self, user_id):
+        """
+        Returns compact entries of given user without materializing them.
+        """
+        return unpack(self._index[user_id])
+
+    def materialized(self):
+        """
+        Returns ids of currently materialized users, most recent last.
+        """
+        with self._lock:
+            return list(self._users)
+
+    def clear(self):
+        """
+        Drops all indexed and materialized data.
+        """
+        with self._lock:
+            self._index = {}
+            self._users.clear()
+
+    def release(self):
+        """
+        Drops materialized users, they are built again when requested.
+        """
+        with self._lock:
+            self._users.clear()
+
+    def compact(self):
+        """
+        Packs entries of every user into a flat array of integers.
+        """
+        with self._lock:
+            for user_id, entries in self._index.items():
+                if not isinstance(entries, array):
+                    values = array('i')
+                    for entry in entries:
+                        values.extend(entry)
+                    self._index[user_id] = values
+
+    def memory_usage(self):
+        """
+        Returns estimated memory used by index, materialized users
+        and aggregates, in bytes.
+        """
+        seen = set()
+        with self._lock:
+            return {
+                'index': deep_size(self._index, seen),
+                'materialized': deep_size(self._users, seen),
+                'aggregates': deep_size(self.aggregates, seen),
+            }
+
+
+def unpack(entries):
+    """
+    Returns entries of user as list of tuples, also when compacted.
+    """
+    if isinstance(entries, array):
+        values = iter(entries)
+        return zip(values, values, values)
+    return entries
+
+
+def materialize(entries):
+    """
+    Builds date/time structure of one user from compact entries.
+    """
+    return {
+        date.fromordinal(day): {
+            'start': seconds_to_time(start),
+            'end': seconds_to_time(end),
+        }
+        for day, start, end in entries
+    }
+
+
+def parse_date(value):
+    """
+    Parses YYYY-MM-DD date into its ordinal.
+    """
+    year, month, day = value.split('-')
+    return date(int(year), int(month), int(day)).toordinal()
+
+
+def parse_time(value):
+    """
+    Parses HH:MM:SS time into seconds since midnight.
+    """
+    hour, minute, second = [int(part) for part in value.split(':')]
+    if not (0 <= hour < 24 and 0 <= minute < 60 and 0 <= second < 60):
+        raise ValueError('Time out of range: {0}'.format(value))
+    return hour * 3600 + minute * 60 + second
+
+
+def seconds_to_time(seconds):
+    """
+    Converts seconds since midnight into datetime.time.
+    """
+    return dtime(seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+_data_locks = {}  # pylint: disable-msg=C0103
+_data_seen = {}  # pylint: disable-msg=C0103
+
+
 def get_data():
     """
     Extracts presence data from CSV file and groups it by user_id.
+    DATA_CSV may also name a binary file written by validate_data script.
+    HOLIDAYS (YYYY-MM-DD dates) and WORKING_WEEKDAYS (0 for Monday)
+    settings define working days of working day aggregates.
 
-    It creates structure like this:
+    Returns PresenceStore which for every user lazily builds
+    structure like this:
     data = {
         'user_id': {
             datetime.date(2013, 10, 1): {
@@ -81,9 +388,148 @@ def get_data():
             },
         }
     }
+
+    The store is cached for every dataset and compared with the file
+    every DATA_CHECK_INTERVAL seconds, it is loaded again only when the
+    file was replaced or modified, so materialized users are kept.
+
+    Files rewritten in place are loaded only once they were left
+    unmodified for DATA_SETTLE_TIME seconds, see settle_time, so a writer
+    pausing between parts is not caught midway. Meanwhile previous data
+    is served, only the first load waits for that, without holding the
+    lock of dataset.
+    The file is loaded again when it changes while being loaded. When no
+    load of LOAD_ATTEMPTS saw it unchanged, previous data is kept and
+    IOError is raised if there is none.
+    """
+    store = mycache.get(DATA_KEY)
+    if store is not None and \
+            store.checked > time.time() - DATA_CHECK_INTERVAL:
+        return store
+    path = setting('DATA_CSV')
+    settle = setting('DATA_SETTLE_TIME', 0)
+    for _ in range(LOAD_ATTEMPTS):
+        signature = file_signature(path)
+        if store is not None and store.signature == signature:
+            store.checked = time.time()
+            return store
+        wait = settle_time(path, signature, settle)
+        if wait > 0:
+            if store is not None:
+                return store
+            time.sleep(wait)
+            continue
+        with _data_locks.setdefault(current_dataset(), threading.Lock()):
+            current = mycache.get(DATA_KEY)
+            if current is not None and current is not store:
+                # loaded by another request meanwhile
+                return current
+            loaded = load_store(path, signature)
+            if loaded is not None:
+                mycache.set(DATA_KEY, loaded, None)
+                return loaded
+        log.warning('%s modified while loading', path)
+
+    if store is not None:
+        log.warning('%s keeps changing, previous data kept', path)
+        return store
+    raise IOError('{0} keeps changing, not loaded'.format(path))
+
+
+def settle_time(path, signature, settle):
+    """
+    Returns seconds left until file with given file_signature was left
+    unmodified for `settle` seconds.
+
+    Time is counted since the signature was first seen by this process,
+    not only since modification time of the file, as a file being
+    truncated may already show its new size with the old time.
     """
-    data = {}
-    with open(app.config['DATA_CSV'], 'r') as csvfile:
+    now = time.time()
+    key = (current_dataset(), path)
+    seen, since = _data_seen.get(key, (None, now))
+    if seen != signature:
+        since = now
+        _data_seen[key] = (signature, since)
+    return settle - (now - max(since, signature[1]))
+
+
+def load_store(path, signature):
+    """
+    Returns PresenceStore of presence file, None when the file no longer
+    has given file_signature once loaded.
+    """
+    index, aggregates = load_rows(path)
+    if file_signature(path) != signature:
+        return None
+    store = PresenceStore(
+        index, setting('PRESENCE_CACHE_USERS', 100), aggregates, signature
+    )
+    enforce_memory_budget(store)
+    return store
+
+
+def load_rows(path):
+    """
+    Returns index of entries by user_id and aggregates of presence file.
+
+    The last row of a repeated (user_id, date) pair replaces earlier
+    ones, like in materialized users, so aggregates are fed only after
+    the whole file is read.
+    """
+    index = {}
+    positions = {}
+    for row in read_rows(path):
+        entries = index.setdefault(row[0], [])
+        key = row[:2]
+        if key in positions:
+            entries[positions[key]] = row[1:]
+        else:
+            positions[key] = len(entries)
+            entries.append(row[1:])
+    del positions
+
+    aggregates = new_aggregates(
+        [parse_date(day) for day in setting('HOLIDAYS', ())],
+        setting('WORKING_WEEKDAYS', WORKING_WEEKDAYS),
+    )
+    for aggregate in aggregates.values():
+        for user_id, entries in index.items():
+            for entry in entries:
+                aggregate.add(user_id, *entry)
+        aggregate.finish()
+    return index, aggregates
+
+
+def parse_row(row):
+    """
+    Parses CSV row into (user_id, date ordinal, start, end) tuple.
+
+    Raises ValueError or TypeError for malformed rows.
+    """
+    if len(row) != 4:
+        raise ValueError('Expected 4 columns, got {0}'.format(len(row)))
+    return (
+        int(row[0]),
+        parse_date(row[1]),
+        parse_time(row[2]),
+        parse_time(row[3]),
+    )
+
+
+def read_rows(path):
+    """
+    Yields (user_id, date ordinal, start, end) rows of presence file.
+
+    Files with BINARY_EXTENSION are read as written by write_binary,
+    others as CSV files with malformed rows skipped.
+    """
+    if path.endswith(BINARY_EXTENSION):
+        for row in read_binary(path):
+            yield row
+        return
+
+    with open(path, 'r') as csvfile:
         presence_reader = csv.reader(csvfile, delimiter=',')
         for i, row in enumerate(presence_reader):
             if len(row) != 4:
@@ -91,16 +537,37 @@ def get_data():
                 continue
 
             try:
-                user_id = int(row[0])
-                date = datetime.strptime(row[1], '%Y-%m-%d').date()
-                start = datetime.strptime(row[2], '%H:%M:%S').time()
-                end = datetime.strptime(row[3], '%H:%M:%S').time()
+                yield parse_row(row)
             except (ValueError, TypeError):
                 log.debug('Problem with line %d: ', i, exc_info=True)
 
-            data.setdefault(user_id, {})[date] = {'start': start, 'end': end}
 
-    return data
+def write_binary(binfile, rows):
+    """
+    Appends rows to binary presence file opened for writing.
+
+    The file holds BINARY_MAGIC followed by native 32-bit integers,
+    four per row, so it is meant to be read on the same platform.
+    """
+    if binfile.tell() == 0:
+        binfile.write(BINARY_MAGIC)
+    values = array('i')
+    for row in rows:
+        values.extend(row)
+    values.tofile(binfile)
+
+
+def read_binary(path):
+    """
+    Returns rows of binary presence file written by write_binary.
+    """
+    with open(path, 'rb') as binfile:
+        if binfile.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+            raise ValueError('Not a presence data file: {0}'.format(path))
+        values = array('i')
+        values.fromstring(binfile.read())
+    columns = iter(values)
+    return zip(columns, columns, columns, columns)
 
 
 def group_by_weekday(items):
@@ -157,9 +624,203 @@ def group_by_weekday_presence(items):
     return mean_start_end
 
 
+_files = {}  # pylint: disable-msg=C0103
+
+
+def file_signature(path):
+    """
+    Returns (inode, modification time, size) of file, which change when
+    the file is replaced or modified.
+
+    Raises IOError when the file is missing, like opening it would.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError as error:
+        raise IOError(error.errno, error.strerror, path)
+    return (stat.st_ino, stat.st_mtime, stat.st_size)
+
+
+def load_file(path, loader):
+    """
+    Returns loader(path), reusing previous result until the file
+    is replaced or modified.
+    """
+    signature = file_signature(path)
+    cached = _files.get((path, loader))
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    result = loader(path)
+    _files[(path, loader)] = (signature, result)
+    return result
+
+
 def read_user_data():
     """
     Read and parse user data from xml file
     and returns it as lxml.etree._ElementTree.
+
+    Parsed file is kept until the file is replaced or modified.
+    """
+    from lxml import etree
+    return load_file(setting('DATA_XML'), etree.parse)
+
+
+def write_atomic(path, content):
+    """
+    Writes file next to path and renames it over path.
+
+    Readers of path see either the old or the new content, never
+    a partially written file.
+    """
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(handle, 'w') as temp_file:
+            temp_file.write(content)
+        os.chmod(temp_path, 0o644)
+        os.rename(temp_path, path)
+    except Exception:
+        os.unlink(temp_path)
+        raise
+
+
+_collation_lock = threading.Lock()  # pylint: disable-msg=C0103
+_collation_ready = []  # pylint: disable-msg=C0103
+
+
+def setup_collation():
+    """
+    Sets up collation locale used to sort user names on first call.
+
+    Locale is taken from COLLATION_LOCALE setting, default collation
+    is used when the locale is not available.
+    """
+    if _collation_ready:
+        return
+    with _collation_lock:
+        if _collation_ready:
+            return
+        name = app.config.get('COLLATION_LOCALE', 'pl_PL.UTF-8')
+        try:
+            locale.setlocale(locale.LC_COLLATE, name)
+        except locale.Error:
+            log.warning('Locale %s not available, using default collation',
+                        name)
+        _collation_ready.append(name)
+
+
+def deep_size(obj, seen=None):
+    """
+    Estimates memory used by object and everything it references, in bytes.
+
+    Objects referenced more than once are counted once. Memory held
+    by C extensions, like lxml trees, is not accounted.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            size += deep_size(key, seen) + deep_size(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += deep_size(item, seen)
+    elif hasattr(obj, '__dict__'):
+        size += deep_size(obj.__dict__, seen)
+    return size
+
+
+def cache_usage(namespace):
+    """
+    Returns estimated memory used by values of cache namespace by key
+    and its total, in bytes.
+    """
+    usage = {}
+    total = 0
+    for key, value in namespace.items():
+        if isinstance(value, PresenceStore):
+            usage[key] = value.memory_usage()
+            total += sum(usage[key].values())
+        else:
+            usage[key] = deep_size(value)
+            total += usage[key]
+    return usage, total
+
+
+def memory_report():
+    """
+    Returns estimated memory used by cached data of this process.
+
+    Sizes are in bytes. Cached data of every dataset is reported with
+    its MEMORY_BUDGET. Parsed XML files are reported with size of the
+    file, memory of parsed tree is a few times larger.
     """
-    return etree.parse(app.config['DATA_XML'])
+    datasets = {}
+    total = 0
+    for name, namespace in mycache.items():
+        usage, used = cache_usage(namespace)
+        datasets['default' if name is None else name] = {
+            'budget': settings(name).get('MEMORY_BUDGET'),
+            'total': used,
+            'cached': usage,
+        }
+        total += used
+
+    files = {}
+    for (path, _), (signature, result) in _files.items():
+        if hasattr(result, 'getroot'):
+            size = signature[2]
+        else:
+            size = deep_size(result)
+        files[path] = files.get(path, 0) + size
+        total += size
+
+    return {
+        'total': total,
+        'datasets': datasets,
+        'files': files,
+    }
+
+
+def enforce_memory_budget(store):
+    """
+    Keeps estimated memory of cached data of current dataset within
+    its MEMORY_BUDGET bytes.
+
+    Called with newly loaded store before it is cached. While the budget
+    is exceeded, materialized users of the dataset's stores are dropped,
+    then the stores are compacted. Logs a warning when the budget is
+    exceeded.
+    """
+    budget = setting('MEMORY_BUDGET')
+    if not budget:
+        return
+    namespace = mycache.namespace(current_dataset())
+
+    def used():
+        """
+        Returns memory used by cached data of dataset and the new store.
+        """
+        return cache_usage(namespace)[1] + sum(store.memory_usage().values())
+
+    total = used()
+    if total <= budget:
+        return
+    log.warning('Memory budget of %d bytes of dataset %s exceeded, '
+                '%d bytes used', budget, current_dataset(), total)
+
+    stores = [store] + [
+        value for _, value in namespace.items()
+        if isinstance(value, PresenceStore)
+    ]
+    for step in (PresenceStore.release, PresenceStore.compact):
+        for item in stores:
+            step(item)
+        total = used()
+        if total <= budget:
+            return
+    log.warning('Memory budget of %d bytes of dataset %s still exceeded, '
+                '%d bytes used', budget, current_dataset(), total)
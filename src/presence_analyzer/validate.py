@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Chunked, resumable validation of presence data files.
+"""
+
+import os
+import csv
+import json
+from datetime import date
+from itertools import islice
+
+from presence_analyzer.utils import (
+    parse_row, read_rows, write_binary, write_atomic, seconds_to_time,
+    BINARY_EXTENSION
+)
+
+ANOMALIES = ('malformed', 'end_before_start', 'duplicate', 'duration')
+MAX_DURATION = 16 * 3600
+
+
+def new_state():
+    """
+    Returns state of validation which did not start yet.
+    """
+    return {
+        'offset': 0,
+        'line': 0,
+        'output_size': 0,
+        'report_size': 0,
+        'counts': dict.fromkeys(('rows', 'clean') + ANOMALIES, 0),
+    }
+
+
+def load_state(checkpoint, path, output, report):
+    """
+    Returns state saved in checkpoint, a new one if there is none,
+    the input file was replaced by a shorter one or output or report
+    file is missing or shorter than what was written to it.
+    """
+    if checkpoint is None or not os.path.exists(checkpoint):
+        return new_state()
+    with open(checkpoint) as checkpoint_file:
+        state = json.load(checkpoint_file)
+    if os.path.getsize(path) < state['offset']:
+        return new_state()
+    for written, size in ((output, 'output_size'), (report, 'report_size')):
+        if not os.path.exists(written) or \
+                os.path.getsize(written) < state[size]:
+            return new_state()
+    return state
+
+
+def check_row(line, seen, max_duration):
+    """
+    Returns (anomaly, row) of single CSV line, anomaly is None for rows
+    which are fine. Remembers (user_id, date) of accepted rows in seen.
+    """
+    try:
+        row = parse_row(next(csv.reader([line])))
+    except (ValueError, TypeError, csv.Error):
+        return 'malformed', None
+    user_id, day, start, end = row
+    if end < start:
+        return 'end_before_start', row
+    if end == start or end - start > max_duration:
+        return 'duration', row
+    if (user_id, day) in seen:
+        return 'duplicate', row
+    seen.add((user_id, day))
+    return None, row
+
+
+def validate(path, output, report, checkpoint=None, chunk_size=10000,
+             max_duration=MAX_DURATION):
+    """
+    Validates presence CSV file chunk by chunk.
+
+    Rows which are malformed, end before they start, repeat a (user_id,
+    date) pair or last zero seconds or longer than max_duration are
+    written to report CSV file as line number, anomaly and the raw line.
+    Remaining rows are written to output, as binary file loaded faster
+    by the server when its name ends with BINARY_EXTENSION, otherwise
+    as CSV file.
+
+    Duplicates are reported, but written to output too, after the row
+    they repeat. The server keeps the last row of a (user_id, date) pair,
+    so it loads the same presence from output as from the input.
+
+    After every chunk the progress is saved in checkpoint file, so
+    a rerun after interruption, or after new rows were appended to the
+    input, continues where the previous one stopped.
+    Returns counts of rows, clean rows and every kind of anomaly.
+    """
+    state = load_state(checkpoint, path, output, report)
+    counts = state['counts']
+
+    with open(path, 'rb') as source, \
+            reopen(output, state['output_size']) as output_file, \
+            reopen(report, state['report_size']) as report_file:
+        # accepted rows are exactly those already in the output
+        seen = set()
+        if state['output_size']:
+            seen.update((row[0], row[1]) for row in read_rows(output))
+        else:
+            write_rows(output_file, output, [])
+
+        source.seek(state['offset'])
+        report_writer = csv.writer(report_file)
+        lines = iter(source.readline, '')
+        while True:
+            chunk = list(islice(lines, chunk_size))
+            if not chunk:
+                break
+            accepted = []
+            for line in chunk:
+                state['line'] += 1
+                if not line.strip():
+                    continue
+                counts['rows'] += 1
+                anomaly, row = check_row(line, seen, max_duration)
+                if anomaly in (None, 'duplicate'):
+                    accepted.append(row)
+                if anomaly is None:
+                    counts['clean'] += 1
+                else:
+                    counts[anomaly] += 1
+                    report_writer.writerow(
+                        [state['line'], anomaly, line.rstrip('\r\n')]
+                    )
+            write_rows(output_file, output, accepted)
+
+            output_file.flush()
+            report_file.flush()
+            state['offset'] = source.tell()
+            state['output_size'] = output_file.tell()
+            state['report_size'] = report_file.tell()
+            if checkpoint is not None:
+                write_atomic(checkpoint, json.dumps(state))
+    return counts
+
+
+def reopen(path, size):
+    """
+    Opens file for writing, dropping anything written after size.
+    """
+    output_file = open(path, 'r+b' if os.path.exists(path) else 'wb')
+    output_file.truncate(size)
+    output_file.seek(size)
+    return output_file
+
+
+def write_rows(output_file, output, rows):
+    """
+    Appends rows to output file, binary or CSV depending on its name.
+    """
+    if output.endswith(BINARY_EXTENSION):
+        write_binary(output_file, rows)
+        return
+    csv.writer(output_file).writerows(
+        [
+            user_id,
+            date.fromordinal(day).isoformat(),
+            seconds_to_time(start).isoformat(),
+            seconds_to_time(end).isoformat(),
+        ]
+        for user_id, day, start, end in rows
+    )
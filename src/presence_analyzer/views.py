@@ -4,12 +4,19 @@ Defines views.
 """
 
 import calendar
-from flask import redirect
+import imghdr
+from flask import redirect, request, abort, url_for, Response
 
 from presence_analyzer.main import app
 from presence_analyzer.utils import (
     jsonify, get_data, mean, group_by_weekday, group_by_weekday_presence,
-    read_user_data
+    read_user_data, setup_collation, memory_report
+)
+from presence_analyzer.stats import SLOTS, slot_label
+from presence_analyzer.datasets import current_dataset
+from presence_analyzer.throttle import coalesce
+from presence_analyzer.directory import (
+    avatar_urls, avatar_path, avatar_dir, read_avatar_index
 )
 from flask import render_template
 
@@ -17,7 +24,6 @@ import logging
 log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
 
 import locale
-locale.setlocale(locale.LC_COLLATE, 'pl_PL.UTF-8')
 
 
 @app.route('/')
@@ -29,6 +35,7 @@ def mainpage():
 
 
 @app.route('/api/v1/users', methods=['GET'])
+@coalesce
 @jsonify
 def users_view():
     """
@@ -40,10 +47,37 @@ def users_view():
 
 
 @app.route('/api/v1/mean_time_weekday/<int:user_id>', methods=['GET'])
+@coalesce
 @jsonify
 def mean_time_weekday_view(user_id):
     """
     Returns mean presence time of given user grouped by weekday.
+
+    With `days=working` argument holidays and weekends are left out,
+    with `days=normalized` presence on working days is divided by number
+    of all working days from the first to the last day of the user,
+    so absences lower the means.
+    """
+    days = request.args.get('days', 'all')
+    if days == 'all':
+        return mean_time_weekday_table(user_id)
+    if days not in ('working', 'normalized'):
+        abort(400)
+
+    data = get_data()
+    if user_id not in data:
+        log.debug('User %s not found!', user_id)
+        return []
+    means = data.aggregates['working_days'].means(
+        user_id, days == 'normalized'
+    )
+    return [(calendar.day_abbr[weekday], value)
+            for weekday, value in enumerate(means)]
+
+
+def mean_time_weekday_table(user_id):
+    """
+    Builds weekday table of mean presence time of given user.
     """
     data = get_data()
     if user_id not in data:
@@ -58,11 +92,19 @@ def mean_time_weekday_view(user_id):
 
 
 @app.route('/api/v1/presence_weekday/<int:user_id>', methods=['GET'])
+@coalesce
 @jsonify
 def presence_weekday_view(user_id):
     """
     Returns total presence time of given user grouped by weekday.
     """
+    return presence_weekday_table(user_id)
+
+
+def presence_weekday_table(user_id):
+    """
+    Builds weekday table of total presence time of given user.
+    """
     data = get_data()
     if user_id not in data:
         log.debug('User %s not found!', user_id)
@@ -81,11 +123,19 @@ def presence_weekday_view(user_id):
 
 
 @app.route('/api/v1/presence_start_end/<int:user_id>', methods=['GET'])
+@coalesce
 @jsonify
 def presence_start_end_view(user_id):
     """
     Returns mean presence time of given user grouped by weekday.
     """
+    return presence_start_end_table(user_id)
+
+
+def presence_start_end_table(user_id):
+    """
+    Builds weekday table of mean arrival and leaving time of given user.
+    """
     data = get_data()
     if user_id not in data:
         log.debug('User %s not found!', user_id)
@@ -109,29 +159,246 @@ def presence_start_end_view(user_id):
     return result
 
 
+@app.route('/api/v1/presence_quantiles/<int:user_id>', methods=['GET'])
+@coalesce
+@jsonify
+def presence_quantiles_view(user_id):
+    """
+    Returns median and 90th percentile of presence time of given user
+    grouped by weekday.
+    """
+    return quantiles_table(user_id, 'presence')
+
+
+@app.route('/api/v1/start_quantiles/<int:user_id>', methods=['GET'])
+@coalesce
+@jsonify
+def start_quantiles_view(user_id):
+    """
+    Returns median and 90th percentile of arrival time of given user
+    grouped by weekday.
+    """
+    return quantiles_table(user_id, 'start')
+
+
+def quantiles_table(user_id, name):
+    """
+    Builds weekday table of median and 90th percentile of given metric.
+    """
+    data = get_data()
+    if user_id not in data:
+        log.debug('User %s not found!', user_id)
+    quantiles = data.aggregates['distributions'].quantiles(
+        user_id, name, (0.5, 0.9)
+    )
+    result = [['Weekday', 'Median (s)', 'P90 (s)']]
+    for weekday, values in enumerate(quantiles):
+        result.append([calendar.day_abbr[weekday]] + values)
+    return result
+
+
+# metric name: whether lowest means rank first by default
+TOP_METRICS = {'presence': False, 'start': True, 'end': False}
+
+
+@app.route('/api/v1/top/<metric>', methods=['GET'])
+@coalesce
+@jsonify
+def top_view(metric):
+    """
+    Returns ranking of users by mean presence time ('presence'), arrival
+    time ('start') or leaving time ('end').
+
+    Accepts `n` (number of users, up to 100), `weekday` (0 for Monday,
+    all weekdays by default) and `order` ('asc' or 'desc') arguments.
+    Earliest arrivals and longest presence rank first by default.
+    """
+    if metric not in TOP_METRICS:
+        abort(404)
+    number = min(request.args.get('n', 10, type=int), 100)
+    weekday = request.args.get('weekday', None, type=int)
+    if weekday is not None and not 0 <= weekday < 7:
+        abort(400)
+    smallest = TOP_METRICS[metric]
+    if 'order' in request.args:
+        smallest = request.args['order'] == 'asc'
+
+    aggregates = get_data().aggregates['weekdays']
+    return [{'user_id': user_id, 'value': value}
+            for user_id, value in aggregates.top(metric, number, weekday,
+                                                 smallest)]
+
+
+@app.route('/api/v1/compare', methods=['GET'])
+@coalesce
+@jsonify
+def compare_view():
+    """
+    Returns mean presence, arrival and leaving time by weekday of users
+    listed in `users` argument, like ?users=10,11, at most 100 of them.
+
+    Every metric is a users x weekdays matrix, rows in order of `users`.
+    'days' tells on how many days of each weekday users were present,
+    'total' how long they were present on them altogether.
+    """
+    try:
+        user_ids = [int(user_id)
+                    for user_id in request.args.get('users', '').split(',')]
+    except ValueError:
+        abort(400)
+    if len(user_ids) > 100:
+        abort(400)
+
+    result = get_data().aggregates['weekdays'].compare(user_ids)
+    result['users'] = user_ids
+    result['weekdays'] = list(calendar.day_abbr)
+    return result
+
+
+@app.route('/api/v1/occupancy', methods=['GET'])
+@coalesce
+@jsonify
+def occupancy_view():
+    """
+    Returns typical day occupancy of the whole office in 15 minute slots.
+    """
+    return occupancy_table(get_data().aggregates['occupancy'].typical_day())
+
+
+@app.route('/api/v1/occupancy/<int:user_id>', methods=['GET'])
+@coalesce
+@jsonify
+def user_occupancy_view(user_id):
+    """
+    Returns typical day presence of given user in 15 minute slots.
+    """
+    data = get_data()
+    if user_id not in data:
+        log.debug('User %s not found!', user_id)
+    return occupancy_table(
+        data.aggregates['occupancy'].typical_day(user_id)
+    )
+
+
+def occupancy_table(weekdays):
+    """
+    Builds table of slots (rows) by weekdays (columns).
+    """
+    result = [['Time'] + list(calendar.day_abbr)]
+    for slot in range(SLOTS):
+        result.append(
+            [slot_label(slot)] + [weekdays[day][slot] for day in range(7)]
+        )
+    return result
+
+
 @app.route('/api/v1/users_data')
+@coalesce
 @jsonify
 def view_users_data():
     """
     Users detailed data listing for dropdown.
     """
-    data = read_user_data()
+    return users_data()
 
-    url = data.find('.//protocol').text + "://" + data.find('.//host').text
+
+def users_data():
+    """
+    Returns details of users from directory sorted by name.
+
+    Avatars prefetched into AVATAR_DIR are served locally, others
+    are linked from the intranet.
+    """
+    data = read_user_data()
+    avatars = avatar_urls(data)
+    cached = {}
+    directory = avatar_dir(current_dataset())
+    if directory:
+        cached = read_avatar_index(directory)
 
     user_data = [{'user_id': i.get('id'), 'name': i.find('.//name').text,
-                  'avatar': url + i.find('.//avatar').text}
+                  'avatar': avatar_url(i.get('id'), avatars, cached)}
                  for i in data.findall('.//user')]
 
+    setup_collation()
     return sorted(user_data, key=lambda k: k['name'], cmp=locale.strcoll)
 
 
+def avatar_url(user_id, avatars, cached):
+    """
+    Returns URL of cached avatar of user, or of the remote one.
+    """
+    if user_id in cached:
+        return url_for('avatar', digest=cached[user_id]['hash'])
+    return avatars[user_id]
+
+
+@app.route('/avatars/<digest>')
+def avatar(digest):
+    """
+    Serves cached avatar by its content hash.
+
+    Content behind the URL never changes, so it may be cached for long.
+    """
+    path = None
+    directory = avatar_dir(current_dataset())
+    if directory:
+        path = avatar_path(directory, digest)
+    if path is None:
+        abort(404)
+    with open(path, 'rb') as avatar_file:
+        content = avatar_file.read()
+    kind = imghdr.what(None, content)
+    response = Response(
+        content,
+        mimetype='image/' + kind if kind else 'application/octet-stream'
+    )
+    response.set_etag(digest)
+    response.cache_control.public = True
+    response.cache_control.max_age = 365 * 24 * 3600
+    return response.make_conditional(request)
+
+
+@app.route('/api/v1/admin/memory', methods=['GET'])
+@jsonify
+def memory_view():
+    """
+    Returns estimated memory used by cached data of the worker, in bytes.
+
+    Available only to clients from ADMIN_ADDRESSES, localhost by default.
+    """
+    if request.remote_addr not in app.config.get('ADMIN_ADDRESSES',
+                                                 ('127.0.0.1',)):
+        abort(403)
+    return memory_report()
+
+
+def render_page(template, table):
+    """
+    Renders chart page with user directory embedded.
+
+    When `user_id` argument is given, chart data of that user is embedded
+    too and the user is selected, so the page draws its chart without
+    any further request.
+    """
+    user_id = request.args.get('user_id', None, type=int)
+    stats = {}
+    if user_id is not None:
+        stats[user_id] = table(user_id)
+    return render_template(
+        template,
+        users=users_data(),
+        stats=stats,
+        selected_user=str(user_id) if user_id is not None else '',
+    )
+
+
 @app.route("/presence_start_end.html")
 def presence_start_end():
     """
     Renders template file for present start/end page
     """
-    return render_template('presence_start_end.html')
+    return render_page('presence_start_end.html', presence_start_end_table)
 
 
 @app.route("/presence_weekday.html")
@@ -139,7 +406,7 @@ def presence_weekday():
     """
     Renders template file for weekday presence page
     """
-    return render_template('presence_weekday.html')
+    return render_page('presence_weekday.html', presence_weekday_table)
 
 
 @app.route("/mean_time_weekday.html")
@@ -147,4 +414,4 @@ def mean_time_weekday():
     """
     Renders template file for mean weekday time page
     """
-    return render_template('mean_time_weekday.html')
+    return render_page('mean_time_weekday.html', mean_time_weekday_table)